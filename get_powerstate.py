@@ -5,28 +5,21 @@
 Copyright (c) 2017 h-mineta <h-mineta@0nyx.net>
 This software is released under the MIT License.
 
-pip3 install pyvmomi pytz
+pip3 install pyvmomi
+pip3 install pytz (Python 3.8 and older only)
 """
 
-import atexit
 import sys
-import re
-from datetime import datetime
 from logging import getLogger, Formatter, StreamHandler, CRITICAL, WARNING, INFO, DEBUG
 logger = getLogger(__name__)
 
-from pyVim import connect
-from pyVmomi import vmodl
-from pyVmomi import vim
-import pytz
-
-from tools import cli, get
+from tools import cli, fanout, get, index, report
 
 def setup_args():
     parser = cli.build_arg_parser()
 
     parser.add_argument('-V', '--vmhost',
-                        required=True,
+                        required=False,
                         help='VMhost name')
 
     parser.add_argument('-O', '--poweroff',
@@ -44,11 +37,47 @@ def setup_args():
                         default='Asia/Tokyo',
                         help='Default time zone (Asia/Tokyo)')
 
-    return cli.prompt_for_password(parser.parse_args())
+    cli.add_vm_selector_arguments(parser)
+
+    args = parser.parse_args()
+    if not args.vmhost and not cli.has_vm_selector(args):
+        parser.error('one of the arguments -V/--vmhost --vm-uuid --vm-ip --vm-path is required')
+
+    return args
+
+def run(service_instance, args):
+    exit_status = 0
+
+    content = service_instance.RetrieveContent()
+    name_index = index.from_args(args)
+    scope = get.get_scope_from_args(content, args)
+    if scope is None:
+        logger.warning('Datacenter, cluster or folder is not found')
+        return 1
+
+    # VM List作成
+    vm_list = get.get_vms_by_selectors(content, args.vmhost, args.vm_uuid, args.vm_ip, args.vm_path, name_index, scope)
+    if len(vm_list) == 0:
+        return fanout.not_found(logger, 'Virtual Machine is not found')
+
+    summary = report.collect_vm_summaries(service_instance, vm_list[:1], ['summary.runtime.powerState'])[0]
+    power = summary.get('summary.runtime.powerState')
+    writer = report.writer_from_args(args)
+    if writer is not None:
+        writer.write({'type': 'powerstate', 'vm': vm_list[0]._moId, 'powerState': power})
+    else:
+        logger.info("Power state: %s" % (power))
+    if args.poweroff == True and power == 'poweredOn':
+        logger.warning('Virtual machine is powered on.')
+        return 3
+    elif args.poweroff == False and power == 'poweredOff':
+        logger.warning('Virtual machine is powered off.')
+        return 3
+
+    return exit_status
 
 def main():
     args = setup_args()
-    exit_status = 0
 
     # logger setting
     formatter = Formatter('[%(asctime)s]%(levelname)s - %(message)s')
@@ -63,56 +92,7 @@ def main():
     console.setFormatter(formatter)
     logger.addHandler(console)
 
-    try:
-        if args.disable_ssl_verification:
-            service_instance = connect.SmartConnectNoSSL(host=args.host,
-                                                         user=args.user,
-                                                         pwd=args.password,
-                                                         port=int(args.port))
-        else:
-            service_instance = connect.SmartConnect(host=args.host,
-                                                    user=args.user,
-                                                    pwd=args.password,
-                                                    port=int(args.port))
-
-        if not service_instance:
-            logger.critical("Could not connect to the specified host ' \
-                            'using specified username and password")
-            sys.exit(1)
-
-        atexit.register(connect.Disconnect, service_instance)
-
-        content = service_instance.RetrieveContent()
-
-        # VM List作成
-        vm_list = get.get_vms_by_names(content, args.vmhost)
-        if len(vm_list) == 0:
-            logger.warning('Virtual Machine is not found')
-            sys.exit(1)
-
-        summary = vm_list[0].summary
-        power = summary.runtime.powerState
-        logger.info("Power state: %s" % (power))
-        if args.poweroff == True and power == 'poweredOn':
-            logger.warning('Virtual machine is powered on.')
-            sys.exit(3)
-        elif args.poweroff == False and power == 'poweredOff':
-            logger.warning('Virtual machine is powered off.')
-            sys.exit(3)
-
-    except vmodl.MethodFault as ex:
-        logger.critical('Caught vmodl fault : ' + ex.msg)
-        import traceback
-        traceback.print_exc()
-        sys.exit(253)
-
-    except Exception as ex:
-        logger.critical('Caught exception : ' + str(ex))
-        import traceback
-        traceback.print_exc()
-        sys.exit(254)
-
-    sys.exit(exit_status)
+    sys.exit(fanout.run(args, run, logger))
 
 # Start program
 if __name__ == "__main__":
@@ -8,13 +8,52 @@ http://www.apache.org/licenses/LICENSE-2.0.html
 """
 from __future__ import print_function
 
+import collections
+import concurrent.futures
 import logging
-from xml.etree.ElementTree import Element
-from xml.etree.ElementTree import SubElement
-from xml.etree.ElementTree import tostring
+import time
+from xml.sax.saxutils import escape
+from xml.sax.saxutils import quoteattr
 
+from pyVmomi import vim
+from pyVmomi import vmodl
 import requests
 
+from tools import pchelper
+
+# Entities whose alarms the fleet wide collection reads by default
+ENTITY_TYPES = [vim.HostSystem, vim.VirtualMachine, vim.Datastore]
+
+# A change seen by watch_alarms: kind is 'added', 'cleared' or 'changed',
+# previous is the state before the change (None when added)
+AlarmEvent = collections.namedtuple('AlarmEvent', ['kind', 'state',
+                                                   'previous'])
+
+# One alarm state, with plain morefs so it can be passed to reset_alarms
+TriggeredAlarm = collections.namedtuple('TriggeredAlarm', [
+    'alarm_moref', 'entity_moref', 'entity_type', 'status', 'time',
+    'acknowledged'])
+
+# The SetAlarmStatus envelope, only the morefs change from one reset to the
+# next.
+_PAYLOAD_TEMPLATE = (
+    '<?xml version="1.0" encoding="UTF-8"?>'
+    '<soap:Envelope xmlns:xsd="http://www.w3.org/2001/XMLSchema"'
+    ' xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance"'
+    ' xmlns:soap="http://schemas.xmlsoap.org/soap/envelope/">'
+    '<soap:Body>'
+    '<SetAlarmStatus xmlns="urn:vim25">'
+    '<_this xsi:type="ManagedObjectReference" type="AlarmManager">'
+    'AlarmManager</_this>'
+    '<alarm type="Alarm">{alarm_moref}</alarm>'
+    '<entity xsi:type="ManagedObjectReference" type={entity_type}>'
+    '{entity_moref}</entity>'
+    '<status>green</status>'
+    '</SetAlarmStatus>'
+    '</soap:Body>'
+    '</soap:Envelope>'
+)
+
 
 def reset_alarm(**kwargs):
     """
@@ -68,40 +107,28 @@ def _build_payload(**kwargs):
         raise ValueError("entity_moref, entity_type, and alarm_moref "
                          "must be set")
 
-    attribs = {
-        'xmlns:xsd': 'http://www.w3.org/2001/XMLSchema',
-        'xmlns:xsi': 'http://www.w3.org/2001/XMLSchema-instance',
-        'xmlns:soap': 'http://schemas.xmlsoap.org/soap/envelope/'
+    return _PAYLOAD_TEMPLATE.format(alarm_moref=escape(alarm_moref),
+                                    entity_type=quoteattr(entity_type),
+                                    entity_moref=escape(entity_moref))
+
+
+def _headers(stub):
+    return {
+        'Cookie': stub.cookie,
+        'SOAPAction': 'urn:vim25',
+        'Content-Type': 'application/xml'
     }
-    root = Element('soap:Envelope', attribs)
-    body = SubElement(root, 'soap:Body')
-    alarm_status = SubElement(body, 'SetAlarmStatus', {'xmlns': 'urn:vim25'})
-    this = SubElement(alarm_status, '_this', {
-        'xsi:type': 'ManagedObjectReference',
-        'type': 'AlarmManager'
-    })
-    this.text = 'AlarmManager'
-    alarm = SubElement(alarm_status, 'alarm', {'type': 'Alarm'})
-    alarm.text = alarm_moref
-    entity = SubElement(alarm_status, 'entity', {
-        'xsi:type': 'ManagedObjectReference',
-        'type': entity_type
-    })
-    entity.text = entity_moref
-    status = SubElement(alarm_status, 'status')
-    status.text = 'green'
-    # I hate hard coding this but I have no idea how to do it any other way
-    # pull requests welcome :)
-    return '<?xml version="1.0" encoding="UTF-8"?>{0}'.format(tostring(root))
-
-
-def _send_request(payload=None, session=None):
+
+
+def _send_request(payload=None, session=None, http_session=None):
     """
     Using requests we send a SOAP envelope directly to the
     vCenter API to reset an alarm to the green state.
 
     :param payload:
     :param session:
+    :param http_session: requests.Session to reuse connections from, see
+                         _http_session
     :return:
     """
     stub = session
@@ -112,11 +139,11 @@ def _send_request(payload=None, session=None):
     logging.debug("Sending {0} to {1}".format(payload, url))
     # I opted to ignore invalid ssl here because that happens in pyvmomi.
     # Once pyvmomi validates ssl it wont take much to make it happen here.
-    res = requests.post(url=url, data=payload, headers={
-        'Cookie': stub.cookie,
-        'SOAPAction': 'urn:vim25',
-        'Content-Type': 'application/xml'
-    }, verify=False)
+    if http_session is not None:
+        res = http_session.post(url=url, data=payload)
+    else:
+        res = requests.post(url=url, data=payload, headers=_headers(stub),
+                            verify=False)
     if res.status_code != 200:
         logging.debug("Failed to reset alarm. HTTP Status: {0}".format(
             res.status_code))
@@ -124,6 +151,63 @@ def _send_request(payload=None, session=None):
     return True
 
 
+def _http_session(stub, max_workers):
+    """
+    A requests.Session carrying the pyvmomi session cookie, whose connection
+    pool keeps one TLS connection alive per worker.
+    """
+    http_session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                            pool_maxsize=max_workers)
+    http_session.mount('https://', adapter)
+    http_session.headers.update(_headers(stub))
+    http_session.verify = False
+    return http_session
+
+
+def reset_alarms(service_instance, alarms, max_workers=8):
+    """
+    Resets many alarms to the green state, over at most max_workers
+    keep-alive connections to the vCenter.
+
+    Usage:
+    SI = SmartConnect(xxx)
+    alarm.reset_alarms(SI, [
+        {'entity_moref': 'host-95', 'entity_type': 'HostSystem',
+         'alarm_moref': 'alarm-1'},
+        ...])
+    :param service_instance:
+    :param alarms: dicts of the reset_alarm arguments, or
+                   (entity_moref, entity_type, alarm_moref) tuples
+    :param max_workers: number of resets sent at the same time
+    :return list: one boolean per alarm, in order
+    """
+    payloads = []
+    for alarm in alarms:
+        if not isinstance(alarm, dict):
+            alarm = dict(zip(('entity_moref', 'entity_type', 'alarm_moref'),
+                             alarm))
+        payloads.append(_build_payload(**alarm))
+    if not payloads:
+        return []
+
+    stub = service_instance._stub
+    http_session = _http_session(stub, max_workers)
+
+    def send(payload):
+        try:
+            return _send_request(payload, stub, http_session)
+        except requests.RequestException as ex:
+            logging.debug("Failed to reset alarm: {0}".format(ex))
+            return False
+
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers) as executor:
+            return list(executor.map(send, payloads))
+    finally:
+        http_session.close()
+
+
 def print_triggered_alarms(entity=None):
     """
     This is a useful method if you need to print out the alarm morefs
@@ -133,8 +217,9 @@ def print_triggered_alarms(entity=None):
     alarms = entity.triggeredAlarmState
     for alarm in alarms:
         print("#"*40)
-        # The alarm key looks like alarm-101.host-95
-        print("alarm_moref: {0}".format(alarm.key.split('.')[0]))
+        # The alarm key looks like alarm-101.host-95, the alarm moref is
+        # also in the state itself
+        print("alarm_moref: {0}".format(alarm.alarm._moId))
         print("alarm status: {0}".format(alarm.overallStatus))
 
 
@@ -144,6 +229,8 @@ def get_alarm_refs(entity=None):
     status for all triggered alarms on a given entity.
 
 
+    Use collect_alarm_states for many entities.
+
     :param entity:
     :return list: [{'alarm':'alarm-101', 'status':'red'}]
     """
@@ -151,8 +238,231 @@ def get_alarm_refs(entity=None):
     ret = []
     for alarm_state in alarm_states:
         tdict = {
-            "alarm": alarm_state.key.split('.')[0],
+            "alarm": alarm_state.alarm._moId,
             "status": alarm_state.overallStatus
         }
         ret.append(tdict)
     return ret
+
+
+class AlarmIndex(object):
+    """
+    Alarm states of many entities, indexed by alarm and by entity.
+
+    - `by_alarm` (dict) maps an alarm moref to its TriggeredAlarm list.
+    - `by_entity` (dict) maps an entity moref to its TriggeredAlarm list.
+    """
+
+    def __init__(self, states=()):
+        self.states = []
+        self.by_alarm = {}
+        self.by_entity = {}
+        for state in states:
+            self.add(state)
+
+    def add(self, state):
+        self.states.append(state)
+        self.by_alarm.setdefault(state.alarm_moref, []).append(state)
+        self.by_entity.setdefault(state.entity_moref, []).append(state)
+
+    def __iter__(self):
+        return iter(self.states)
+
+    def __len__(self):
+        return len(self.states)
+
+    def reset_args(self, status=None):
+        """
+        The reset_alarms arguments of the states, or of the states with the
+        given overall status ('red', 'yellow', ...) only.
+        """
+        return [(state.entity_moref, state.entity_type, state.alarm_moref)
+                for state in self.states
+                if status is None or state.status == status]
+
+
+def _to_triggered_alarm(alarm_state, interned):
+    entity = alarm_state.entity
+    entity_type = entity._wsdlName
+    status = alarm_state.overallStatus
+    return TriggeredAlarm(
+        interned.setdefault(alarm_state.alarm._moId, alarm_state.alarm._moId),
+        entity._moId,
+        interned.setdefault(entity_type, entity_type),
+        interned.setdefault(status, status),
+        alarm_state.time,
+        alarm_state.acknowledged)
+
+
+def collect_alarm_states(service_instance, entity_types=None, container=None,
+                         declared=False, max_objects=None):
+    """
+    Reads the alarm states of all entities of entity_types in one property
+    collection, instead of one triggeredAlarmState read per entity.
+
+    Usage:
+    SI = SmartConnect(xxx)
+    alarms = alarm.collect_alarm_states(SI)
+    for state in alarms.by_entity.get('host-95', []):
+        print(state.alarm_moref, state.status)
+
+    :param service_instance:
+    :param entity_types: managed entity types, defaults to ENTITY_TYPES
+    :param container: folder, datacenter or cluster to collect from, the
+                      root folder by default
+    :param declared: read declaredAlarmState (every alarm defined on the
+                     entities, green included) through a full inventory
+                     traversal instead of triggeredAlarmState through a
+                     container view
+    :param max_objects: page size of the collection
+    :return AlarmIndex:
+    """
+    entity_types = entity_types or ENTITY_TYPES
+    content = service_instance.content
+
+    view_ref = None
+    if declared:
+        filter_spec = pchelper.build_traversal_filter_spec(
+            container or content.rootFolder, entity_types,
+            ['declaredAlarmState'])
+    else:
+        view_ref = pchelper.get_container_view(service_instance,
+                                               entity_types, container)
+        filter_spec = pchelper.build_filter_spec(view_ref, entity_types,
+                                                 ['triggeredAlarmState'])
+
+    interned = {}
+    index = AlarmIndex()
+    try:
+        for obj in pchelper.retrieve_objects(content.propertyCollector,
+                                             [filter_spec], max_objects):
+            for prop in obj.propSet:
+                for alarm_state in prop.val or []:
+                    index.add(_to_triggered_alarm(alarm_state, interned))
+    finally:
+        if view_ref is not None:
+            view_ref.Destroy()
+
+    return index
+
+
+def _diff(before, after):
+    """
+    Events turning the {alarm_moref: TriggeredAlarm} of an entity from
+    before into after.
+    """
+    events = []
+    for alarm_moref, state in after.items():
+        previous = before.get(alarm_moref)
+        if previous is None:
+            events.append(AlarmEvent('added', state, None))
+        elif (previous.status, previous.acknowledged) != \
+                (state.status, state.acknowledged):
+            events.append(AlarmEvent('changed', state, previous))
+    for alarm_moref, previous in before.items():
+        if alarm_moref not in after:
+            events.append(AlarmEvent('cleared', previous, previous))
+    return events
+
+
+def watch_alarms(service_instance, entity_types=None, container=None,
+                 max_wait_seconds=60, timeout=None, initial=False,
+                 reset_policy=None, max_workers=8):
+    """
+    Streams alarm changes from a property filter on triggeredAlarmState
+    instead of rescanning: the server only answers when an alarm is
+    triggered, cleared or changes status or acknowledgement.
+
+    Usage:
+    SI = SmartConnect(xxx)
+    for event in alarm.watch_alarms(SI):
+        print(event.kind, event.state.entity_moref, event.state.alarm_moref,
+              event.state.status)
+
+    :param service_instance:
+    :param entity_types: managed entity types, defaults to ENTITY_TYPES
+    :param container: folder, datacenter or cluster to watch, the root
+                      folder by default
+    :param max_wait_seconds: longest wait of one WaitForUpdatesEx call
+    :param timeout: seconds after which the generator stops, None to watch
+                    until it is closed
+    :param initial: if True the alarms already triggered are yielded as
+                    'added' first
+    :param reset_policy: callable taking an AlarmEvent, the alarms of the
+                         events it returns True for are reset to green
+                         with reset_alarms
+    :param max_workers: number of resets sent at the same time
+    :return generator: AlarmEvent
+    """
+    entity_types = entity_types or ENTITY_TYPES
+    content = service_instance.content
+    deadline = None
+    if timeout is not None:
+        deadline = time.time() + timeout
+
+    # A collector of our own, so no other filter of the session sees (or
+    # consumes) these updates
+    collector = content.propertyCollector.CreatePropertyCollector()
+    view_ref = pchelper.get_container_view(service_instance, entity_types,
+                                           container)
+    try:
+        # No partial updates: every change carries the whole
+        # triggeredAlarmState array of the entity, diffed below
+        collector.CreateFilter(pchelper.build_filter_spec(
+            view_ref, entity_types, ['triggeredAlarmState']), False)
+
+        interned = {}
+        alarms = {}
+        version = None
+        first = True
+        while True:
+            wait = max_wait_seconds
+            if deadline is not None:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return
+                wait = int(min(wait, max(remaining, 1)))
+
+            options = vmodl.query.PropertyCollector.WaitOptions()
+            options.maxWaitSeconds = wait
+            update = collector.WaitForUpdatesEx(version, options)
+            if update is None:
+                continue
+            version = update.version
+
+            events = []
+            for filter_set in update.filterSet:
+                for obj_set in filter_set.objectSet:
+                    entity_moref = obj_set.obj._moId
+                    after = {}
+                    if obj_set.kind != 'leave':
+                        for change in obj_set.changeSet:
+                            for alarm_state in change.val or []:
+                                state = _to_triggered_alarm(alarm_state,
+                                                            interned)
+                                after[state.alarm_moref] = state
+                    events.extend(_diff(alarms.get(entity_moref, {}), after))
+                    if after:
+                        alarms[entity_moref] = after
+                    else:
+                        alarms.pop(entity_moref, None)
+
+            if first and not initial:
+                first = False
+                continue
+            first = False
+
+            if reset_policy is not None:
+                resets = [event.state for event in events
+                          if event.kind != 'cleared' and reset_policy(event)]
+                if resets:
+                    reset_alarms(service_instance,
+                                 [(state.entity_moref, state.entity_type,
+                                   state.alarm_moref) for state in resets],
+                                 max_workers)
+
+            for event in events:
+                yield event
+    finally:
+        collector.DestroyPropertyCollector()
+        view_ref.Destroy()
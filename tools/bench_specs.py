@@ -0,0 +1,67 @@
+"""
+Micro-benchmark of the property filter spec cache of tools.pchelper.
+
+Times build_filter_spec and build_traversal_filter_spec with the cached
+traversal and property specs, and with the cache cleared before every call
+(the cost of building everything, as before the cache). No vCenter is
+needed, the specs are only built.
+
+Usage:
+    python -m tools.bench_specs -n 2000
+"""
+
+import argparse
+import timeit
+
+from pyVmomi import vim
+
+from tools import pchelper
+
+TYPES = [vim.HostSystem, vim.VirtualMachine, vim.Datastore]
+PATHS = ['name', 'runtime.powerState', 'summary.config.memorySizeMB',
+         'triggeredAlarmState']
+
+
+def _uncached(build):
+    def run():
+        pchelper.clear_spec_cache()
+        build()
+    return run
+
+
+def bench(build, number, repeat=5):
+    """
+    Returns the best time of one call of build, in microseconds.
+    """
+    return min(timeit.repeat(build, number=number, repeat=repeat)) \
+        / number * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Times the filter spec builders with and without the '
+                    'spec cache')
+    parser.add_argument('-n', '--number',
+                        type=int,
+                        default=2000,
+                        help='Calls per measure (default: 2000)')
+    args = parser.parse_args()
+
+    view_ref = vim.view.ContainerView('session[bench]view-1')
+    root = vim.Folder('group-d1')
+    builders = [
+        ('build_filter_spec',
+         lambda: pchelper.build_filter_spec(view_ref, TYPES, PATHS)),
+        ('build_traversal_filter_spec',
+         lambda: pchelper.build_traversal_filter_spec(root, TYPES, PATHS)),
+    ]
+
+    print('%-30s %12s %12s' % ('', 'uncached us', 'cached us'))
+    for name, build in builders:
+        uncached = bench(_uncached(build), args.number)
+        cached = bench(build, args.number)
+        print('%-30s %12.1f %12.1f' % (name, uncached, cached))
+
+
+if __name__ == "__main__":
+    main()
@@ -22,24 +22,72 @@ import getpass
 __author__ = "VMware, Inc."
 
 
+class _AppendHostAction(argparse.Action):
+    """
+    Collects every -s into args.hosts, args.host being the first one.
+    """
+
+    def _add_hosts(self, namespace, hosts):
+        all_hosts = list(getattr(namespace, 'hosts', None) or [])
+        all_hosts.extend(hosts)
+        namespace.hosts = all_hosts
+        if all_hosts:
+            setattr(namespace, self.dest, all_hosts[0])
+
+    def __call__(self, parser, namespace, values, option_string=None):
+        self._add_hosts(namespace, [values])
+
+
+class _HostFileAction(_AppendHostAction):
+    """
+    Reads the hosts of --host-file, skipping blank lines and # comments.
+    """
+
+    def __call__(self, parser, namespace, values, option_string=None):
+        try:
+            with open(values) as host_file:
+                hosts = [line.split('#', 1)[0].strip() for line in host_file]
+        except (IOError, OSError) as ex:
+            parser.error('Could not read {0}: {1}'.format(values, ex))
+
+        hosts = [host for host in hosts if host]
+        if not hosts:
+            parser.error('No host found in {0}'.format(values))
+        self._add_hosts(namespace, hosts)
+
+
 def build_arg_parser():
     """
     Builds a standard argument parser with arguments for talking to vCenter
 
-    -s service_host_name_or_ip
+    -s service_host_name_or_ip (repeatable) or --host-file file_of_hosts
     -o optional_port_number
     -u required_user
     -p optional_password
+    --datacenter, --cluster or --folder optional_lookup_scope
+    --output text|jsonl
+    --index-file optional_name_index_file
 
     """
     parser = argparse.ArgumentParser(
         description='Standard Arguments for talking to vCenter')
 
     # because -h is reserved for 'help' we use -s for service
-    parser.add_argument('-s', '--host',
-                        required=True,
+    hosts = parser.add_mutually_exclusive_group(required=True)
+    hosts.add_argument('-s', '--host',
+                       action=_AppendHostAction,
+                       help='vSphere service to connect to, may be repeated')
+
+    hosts.add_argument('--host-file',
+                       dest='host',
+                       action=_HostFileAction,
+                       help='File listing the vSphere services to connect to, one per line')
+
+    parser.add_argument('--fanout-workers',
+                        type=int,
+                        default=None,
                         action='store',
-                        help='vSphere service to connect to')
+                        help='Number of vSphere services handled at the same time (default: all)')
 
     # because we want -p for password, we use -o for port
     parser.add_argument('-o', '--port',
@@ -63,9 +111,134 @@ def build_arg_parser():
                         action='store_true',
                         help='Disable ssl host certificate verification')
 
+    parser.add_argument('--datacenter',
+                        required=False,
+                        action='store',
+                        help='Only look up objects in this datacenter (inventory path)')
+
+    scope = parser.add_mutually_exclusive_group()
+    scope.add_argument('--cluster',
+                       required=False,
+                       action='store',
+                       help='Only look up VMs, hosts and pools in this cluster'
+                            ' (path under the datacenter host folder, or full inventory path)')
+
+    scope.add_argument('--folder',
+                       required=False,
+                       action='store',
+                       help='Only look up VMs in this folder'
+                            ' (path under the datacenter vm folder, or full inventory path)')
+
+    parser.add_argument('--output',
+                        required=False,
+                        choices=['text', 'jsonl'],
+                        default='text',
+                        help='text logs, or one JSON record per line on stdout as results arrive (default: text)')
+
+    parser.add_argument('--output-localtime',
+                        required=False,
+                        action='store_true',
+                        help='Write JSON times in --timezone instead of UTC')
+
+    parser.add_argument('--index-file',
+                        required=False,
+                        action='store',
+                        help='Cache name to MoRef lookups in this file')
+
+    parser.add_argument('--index-ttl',
+                        type=int,
+                        default=3600,
+                        action='store',
+                        help='Seconds a cached lookup is trusted (default: 3600)')
+
+    parser.add_argument('--session-cache',
+                        required=False,
+                        action='store_true',
+                        help='Reuse the vCenter session across invocations')
+
+    parser.add_argument('--session-expiry',
+                        type=int,
+                        default=1800,
+                        action='store',
+                        help='Seconds a cached session is reused for (default: 1800)')
+
     return parser
 
 
+def add_task_limit_arguments(parser):
+    """
+    Adds the arguments limiting how many tasks run at the same time, for
+    scripts which submit one task per virtual machine.
+    """
+    parser.add_argument('--max-tasks',
+                        type=int,
+                        default=None,
+                        action='store',
+                        help='Maximum number of running tasks (default: no limit)')
+
+    parser.add_argument('--max-tasks-per-host',
+                        type=int,
+                        default=None,
+                        action='store',
+                        help='Maximum number of running tasks per ESXi host')
+
+    parser.add_argument('--max-tasks-per-datastore',
+                        type=int,
+                        default=None,
+                        action='store',
+                        help='Maximum number of running tasks per datastore')
+
+    parser.add_argument('--max-tasks-per-cluster',
+                        type=int,
+                        default=None,
+                        action='store',
+                        help='Maximum number of running tasks per cluster')
+
+    return parser
+
+
+def add_vm_selector_arguments(parser):
+    """
+    Adds the arguments selecting virtual machines without a name lookup,
+    resolved server side by the SearchIndex
+    """
+    parser.add_argument('--vm-uuid',
+                        required=False,
+                        action='append',
+                        help='Virtual machine BIOS or instance UUID, may be repeated')
+
+    parser.add_argument('--vm-ip',
+                        required=False,
+                        action='append',
+                        help='Virtual machine IP address, may be repeated')
+
+    parser.add_argument('--vm-path',
+                        required=False,
+                        action='append',
+                        help='Virtual machine inventory path (DC/vm/folder/name), may be repeated')
+
+    return parser
+
+
+def has_vm_selector(args):
+    """
+    True if one of the add_vm_selector_arguments arguments is given
+    """
+    return bool(args.vm_uuid or args.vm_ip or args.vm_path)
+
+
+def get_task_limits(args):
+    """
+    Returns the per-resource limits of add_task_limit_arguments as a dict
+    for tools.tasks.TaskScheduler
+    """
+    return {
+        'host': args.max_tasks_per_host,
+        'datastore': args.max_tasks_per_datastore,
+        'cluster': args.max_tasks_per_cluster,
+    }
+
+
 def prompt_for_password(args):
     """
     if no password is specified on the command line, prompt for it
@@ -0,0 +1,372 @@
+"""
+Columnar export of inventory snapshots for analytics.
+
+A snapshot is collected column by column with pchelper.collect_columns and
+written straight to an Arrow IPC file (.arrow), a Parquet file (.parquet)
+or a NumPy archive (.npz). Text columns are dictionary encoded. Arrow files
+can be reloaded with zero copy through a memory map.
+
+pyarrow is needed for Arrow and Parquet, numpy for .npz. Neither is
+required by the rest of the tools package.
+
+Several types are collected together with one traversal of the inventory
+(snapshot_types), and written to one file per type.
+
+Usage:
+    python -m tools.export -s vcenter -u user --type vm -f vms.arrow
+    python -m tools.export -s vcenter -u user --type vm --type host \
+        --type datastore -f inventory.parquet
+"""
+
+import collections
+import os
+
+from pyVmomi import vim
+
+from tools import cli
+from tools import get
+from tools import pchelper
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+except ImportError:
+    pyarrow = None
+
+try:
+    import pyarrow.parquet
+except ImportError:
+    pass
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+TYPES = {
+    'vm': vim.VirtualMachine,
+    'host': vim.HostSystem,
+    'datastore': vim.Datastore,
+}
+
+DEFAULT_PATHS = {
+    'vm': [
+        'name',
+        'config.hardware.numCPU',
+        'config.hardware.numCoresPerSocket',
+        'config.hardware.memoryMB',
+        'config.guestFullName',
+        'runtime.powerState',
+        'runtime.host',
+    ],
+    'host': [
+        'name',
+        'parent',
+        'summary.hardware.numCpuCores',
+        'summary.hardware.cpuMhz',
+        'summary.hardware.memorySize',
+        'summary.quickStats.overallCpuUsage',
+        'summary.quickStats.overallMemoryUsage',
+        'runtime.connectionState',
+    ],
+    'datastore': [
+        'name',
+        'summary.type',
+        'summary.capacity',
+        'summary.freeSpace',
+    ],
+}
+
+FORMATS = {
+    '.arrow': 'arrow',
+    '.feather': 'arrow',
+    '.ipc': 'arrow',
+    '.parquet': 'parquet',
+    '.npz': 'npz',
+}
+
+
+def _plain(value):
+    """
+    Managed object references become their MoRef id, enums their name.
+    """
+    if value is None or isinstance(value, (bool, int, float)):
+        return value
+    if hasattr(value, '_moId'):
+        return value._moId
+    return str(value)
+
+
+def snapshot(service_instance, obj_type=vim.VirtualMachine, path_set=None,
+             container=None, max_objects=1000):
+    """
+    Collects a snapshot of all objects of obj_type as plain columns.
+
+    Args:
+        service_instance (ServiceInstance): ServiceInstance connection
+        obj_type            (pyVmomi.vim.*): Type of managed object
+        path_set                    (list): Properties to export, the
+                                            DEFAULT_PATHS of the type if empty
+        container      (vim.ManagedEntity): Root of the snapshot, defaults to
+                                            the root folder
+        max_objects                  (int): Page size of the collection
+
+    Returns:
+        A dict of column name to list of int, float, bool, str or None, with
+        the MoRef ids in the 'moid' column
+    """
+    if not path_set:
+        names = dict((type_, name) for name, type_ in TYPES.items())
+        if obj_type not in names:
+            raise ValueError("no default properties for {0}, give a "
+                             "path_set".format(obj_type.__name__))
+        path_set = DEFAULT_PATHS[names[obj_type]]
+    view_ref = pchelper.get_container_view(service_instance, [obj_type],
+                                           container)
+    try:
+        columns = pchelper.collect_columns(service_instance, view_ref,
+                                           obj_type, path_set,
+                                           include_mors=True,
+                                           max_objects=max_objects)
+    finally:
+        view_ref.Destroy()
+
+    plain = {'moid': [obj._moId for obj in columns.pop('obj')]}
+    for path in path_set:
+        plain[path] = _plain_column(columns[path])
+    return plain
+
+
+def _plain_column(values):
+    # Interned values are converted once
+    converted = {}
+    column = []
+    for value in values:
+        key = id(value)
+        if key not in converted:
+            converted[key] = _plain(value)
+        column.append(converted[key])
+    return column
+
+
+def snapshot_types(service_instance, names, path_sets=None, scope=None,
+                   max_objects=1000):
+    """
+    Collects the snapshots of several types at once, with one traversal of
+    the inventory (pchelper.snapshot_inventory) per distinct container
+    instead of one view and collection per type.
+
+    Args:
+        service_instance (ServiceInstance): ServiceInstance connection
+        names                       (list): Keys of TYPES to export
+        path_sets                   (dict): Key of TYPES to the properties
+                                            to export, DEFAULT_PATHS if
+                                            missing
+        scope                       (dict): tools.get scope, the container
+                                            of each type
+        max_objects                  (int): Page size of the collection
+
+    Returns:
+        A dict of key of TYPES to columns as returned by snapshot(), with a
+        'parent' column as well
+    """
+    path_sets = dict((name, list((path_sets or {}).get(name) or
+                                 DEFAULT_PATHS[name]))
+                     for name in names)
+    for path_set in path_sets.values():
+        if 'parent' not in path_set:
+            path_set.append('parent')
+
+    groups = collections.OrderedDict()
+    for name in names:
+        container = (scope or {}).get(TYPES[name])
+        groups.setdefault(container, []).append(name)
+
+    snapshots = {}
+    for container, group in groups.items():
+        inventory = pchelper.snapshot_inventory(
+            service_instance, [TYPES[name] for name in group],
+            dict((TYPES[name], path_sets[name]) for name in group),
+            container, max_objects)
+        for name in group:
+            objects = inventory.objects[TYPES[name]]
+            columns = {'moid': [obj._moId for obj in objects]}
+            for path in path_sets[name]:
+                columns[path] = _plain_column(
+                    properties.get(path) for properties in objects.values())
+            snapshots[name] = columns
+    return snapshots
+
+
+def _is_numeric(values):
+    return all(value is None or (isinstance(value, (int, float)) and
+                                 not isinstance(value, bool))
+               for value in values)
+
+
+def _is_categorical(values):
+    """
+    Text columns with many repeated values (power states, hosts, guest OS)
+    are worth dictionary encoding, unique ones (names, MoRef ids) are not.
+    """
+    return len(set(values)) * 2 <= len(values)
+
+
+def to_arrow(columns):
+    """
+    Builds a pyarrow Table, dictionary encoding the repetitive text columns.
+    """
+    if pyarrow is None:
+        raise RuntimeError("pyarrow is required for Arrow and Parquet export")
+
+    arrays = []
+    for values in columns.values():
+        array = pyarrow.array(values)
+        if pyarrow.types.is_string(array.type) and _is_categorical(values):
+            array = array.dictionary_encode()
+        arrays.append(array)
+    return pyarrow.Table.from_arrays(arrays, names=list(columns))
+
+
+def write_arrow(columns, path):
+    table = to_arrow(columns)
+    with pyarrow.OSFile(path, 'wb') as sink:
+        with pyarrow.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+
+
+def write_parquet(columns, path):
+    pyarrow.parquet.write_table(to_arrow(columns), path)
+
+
+def write_npz(columns, path):
+    """
+    Numeric columns are stored as int64, or float64 with NaN when values are
+    missing. Repetitive text columns are stored as int32 codes (-1 when
+    missing) with their categories in '<column>.categories', other columns as
+    unicode arrays.
+    """
+    if numpy is None:
+        raise RuntimeError("numpy is required for .npz export")
+
+    arrays = {}
+    for name, values in columns.items():
+        if _is_numeric(values) and values:
+            if any(value is None for value in values) or \
+                    any(isinstance(value, float) for value in values):
+                arrays[name] = numpy.array(
+                    [numpy.nan if value is None else value
+                     for value in values], dtype=numpy.float64)
+            else:
+                arrays[name] = numpy.array(values, dtype=numpy.int64)
+            continue
+
+        if not _is_categorical(values):
+            arrays[name] = numpy.array(
+                ['' if value is None else str(value) for value in values],
+                dtype=numpy.str_)
+            continue
+
+        categories = {}
+        codes = numpy.empty(len(values), dtype=numpy.int32)
+        for index, value in enumerate(values):
+            if value is None:
+                codes[index] = -1
+            else:
+                codes[index] = categories.setdefault(str(value),
+                                                     len(categories))
+        arrays[name] = codes
+        arrays[name + '.categories'] = numpy.array(list(categories),
+                                                   dtype=numpy.str_)
+
+    numpy.savez(path, **arrays)
+
+
+def export(columns, path, format_=None):
+    """
+    Writes columns to path, in the format given or guessed from the file
+    extension.
+    """
+    format_ = format_ or FORMATS.get(os.path.splitext(path)[1].lower())
+    if format_ == 'arrow':
+        write_arrow(columns, path)
+    elif format_ == 'parquet':
+        write_parquet(columns, path)
+    elif format_ == 'npz':
+        write_npz(columns, path)
+    else:
+        raise ValueError("Unknown export format for {0}".format(path))
+
+
+def load(path):
+    """
+    Reloads an export. Arrow files are memory mapped (zero copy) and
+    returned as a pyarrow Table, as are Parquet files. .npz files return the
+    numpy NpzFile.
+    """
+    format_ = FORMATS.get(os.path.splitext(path)[1].lower())
+    if format_ == 'arrow':
+        return pyarrow.ipc.open_file(pyarrow.memory_map(path, 'r')).read_all()
+    elif format_ == 'parquet':
+        return pyarrow.parquet.read_table(path, memory_map=True)
+    elif format_ == 'npz':
+        return numpy.load(path)
+    raise ValueError("Unknown export format for {0}".format(path))
+
+
+def main():
+    from tools import session
+
+    parser = cli.build_arg_parser()
+    parser.add_argument('-f', '--output-file',
+                        required=True,
+                        action='store',
+                        help='File to write (.arrow, .parquet or .npz), '
+                             'suffixed with the type when there are several')
+    parser.add_argument('--format',
+                        required=False,
+                        choices=['arrow', 'parquet', 'npz'],
+                        help='Output format (default: from the file extension)')
+    parser.add_argument('--type',
+                        required=False,
+                        action='append',
+                        choices=sorted(TYPES),
+                        help='Managed object type to export, may be repeated '
+                             'to export several types from one inventory '
+                             'traversal (default: vm)')
+    parser.add_argument('--path',
+                        required=False,
+                        action='append',
+                        help='Property path to export, may be repeated '
+                             '(default: a per type selection)')
+    args = parser.parse_args()
+
+    service_instance = session.connect_from_args(args)
+    if not service_instance:
+        raise SystemExit("Could not connect to the specified host using "
+                         "specified username and password")
+
+    scope = get.get_scope_from_args(service_instance.content, args)
+    if scope is None:
+        raise SystemExit("Datacenter, cluster or folder is not found")
+
+    names = list(collections.OrderedDict.fromkeys(args.type or ['vm']))
+    if len(names) == 1:
+        columns = snapshot(service_instance, TYPES[names[0]],
+                           args.path or DEFAULT_PATHS[names[0]],
+                           scope[TYPES[names[0]]])
+        export(columns, args.output_file, args.format)
+        return
+
+    # --path applies to every type
+    snapshots = snapshot_types(service_instance, names,
+                               dict((name, args.path) for name in names),
+                               scope)
+    base, extension = os.path.splitext(args.output_file)
+    for name in names:
+        export(snapshots[name], '{0}-{1}{2}'.format(base, name, extension),
+               args.format)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,211 @@
+"""
+Runs the same operation against several vCenters at the same time.
+
+The scripts accept several -s/--host (or a --host-file). Each vCenter is
+handled by its own worker with its own connection, and the per-vCenter
+exit statuses are folded into one.
+
+An operation is a function (service_instance, args) returning an exit
+status. It must not call sys.exit(). Returning NOT_FOUND (through
+not_found(), from the first lookup of the objects it was asked about) means
+they do not live on that vCenter; this only counts as a failure, exit
+status NOT_FOUND_STATUS, when no vCenter found them. Any other non-zero
+status is a failure of that vCenter.
+
+With several vCenters the records logged from a worker are prefixed with
+its vCenter.
+"""
+
+import concurrent.futures
+import copy
+import logging
+import threading
+import traceback
+
+from pyVmomi import vmodl
+
+from tools import cli
+from tools import session
+
+# Not an exit status: only returned by operations, never by run()
+NOT_FOUND = -1
+NOT_FOUND_STATUS = 1
+CONNECT_FAILED = 1
+FAULT = 253
+EXCEPTION = 254
+
+
+# The vCenter of the current worker thread, and whether others run too
+_worker = threading.local()
+
+
+class FanoutResult(object):
+    """
+    The outcome of an operation on one vCenter.
+    """
+
+    def __init__(self, host, status, found=True, message=None):
+        self.host = host
+        self.status = status
+        self.found = found
+        # The not_found() message, when not found
+        self.message = message
+
+    def __repr__(self):
+        return 'FanoutResult(host={0!r}, status={1!r}, found={2!r})'.format(
+            self.host, self.status, self.found)
+
+
+class _SharedPassword(object):
+    """
+    Password prompt shared by the workers: the first one needing the
+    password asks for it, the others wait and reuse the answer.
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self._lock = threading.Lock()
+
+    def __call__(self, args):
+        if not args.password:
+            with self._lock:
+                cli.prompt_for_password(self.args)
+            args.password = self.args.password
+        return args
+
+
+class _VCenterFilter(logging.Filter):
+    """
+    Prefixes the records logged from a fanout worker with its vCenter.
+    """
+
+    def filter(self, record):
+        host = getattr(_worker, 'host', None)
+        if host is not None and getattr(_worker, 'several', False) and \
+                not getattr(record, 'vcenter', None):
+            record.vcenter = host
+            record.msg = '[%s] %s' % (host, record.getMessage())
+            record.args = None
+        return True
+
+
+def not_found(logger, message):
+    """
+    Logs that the objects looked up are not on this vCenter and returns
+    NOT_FOUND. The message is only a warning when there is one vCenter,
+    run() warns once if no vCenter found them.
+    """
+    _worker.message = message
+    if getattr(_worker, 'several', False):
+        logger.debug(message)
+    else:
+        logger.warning(message)
+    return NOT_FOUND
+
+
+def _run_one(args, operation, logger, several=False):
+    _worker.host = args.host
+    _worker.several = several
+    _worker.message = None
+    try:
+        service_instance = session.connect_from_args(args)
+        if not service_instance:
+            logger.critical('Could not connect to %s using specified '
+                            'username and password', args.host)
+            return FanoutResult(args.host, CONNECT_FAILED)
+
+        status = operation(service_instance, args)
+        if status == NOT_FOUND:
+            return FanoutResult(args.host, NOT_FOUND_STATUS, False,
+                                _worker.message)
+        return FanoutResult(args.host, status)
+
+    except vmodl.MethodFault as ex:
+        logger.critical('Caught vmodl fault : %s', ex.msg)
+        traceback.print_exc()
+        return FanoutResult(args.host, FAULT)
+
+    except Exception as ex:
+        logger.critical('Caught exception : %s', ex)
+        traceback.print_exc()
+        return FanoutResult(args.host, EXCEPTION)
+
+    finally:
+        _worker.host = None
+        _worker.several = False
+
+
+def run_all(args, operation, logger=None):
+    """
+    Runs operation against every host of args.
+
+    Returns:
+        The list of FanoutResult, in the order of the hosts
+    """
+    logger = logger or logging.getLogger(__name__)
+    hosts = getattr(args, 'hosts', None) or [args.host]
+
+    if len(hosts) == 1:
+        return [_run_one(args, operation, logger)]
+
+    # Ask once rather than from every worker. With the session cache only
+    # the vCenters without a valid session need it, so ask on first need.
+    prompt = None
+    if getattr(args, 'session_cache', False):
+        prompt = _SharedPassword(args)
+    else:
+        cli.prompt_for_password(args)
+
+    workers = getattr(args, 'fanout_workers', None) or len(hosts)
+    host_args = []
+    for host in hosts:
+        args_ = copy.copy(args)
+        args_.host = host
+        args_.hosts = [host]
+        args_.password_prompt = prompt
+        host_args.append(args_)
+
+    # The scripts log on their own logger, the tools modules on the root one
+    vcenter_filter = _VCenterFilter()
+    loggers = [logger, logging.getLogger()]
+    for logger_ in loggers:
+        logger_.addFilter(vcenter_filter)
+    try:
+        with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+            futures = [executor.submit(_run_one, args_, operation, logger,
+                                       True)
+                       for args_ in host_args]
+            return [future.result() for future in futures]
+    finally:
+        for logger_ in loggers:
+            logger_.removeFilter(vcenter_filter)
+
+
+def exit_status(results):
+    """
+    Folds the per-vCenter results into one exit status: the worst status of
+    the vCenters where the objects were found, NOT_FOUND_STATUS if none
+    found them.
+    """
+    found = [result for result in results if result.found]
+    if not found:
+        return NOT_FOUND_STATUS
+    return max(result.status for result in found)
+
+
+def run(args, operation, logger=None):
+    """
+    Runs operation against every host of args, logs a summary when there are
+    several, and returns the combined exit status.
+    """
+    results = run_all(args, operation, logger)
+    if len(results) > 1:
+        logger = logger or logging.getLogger(__name__)
+        for result in results:
+            logger.info('vCenter: %s, Found: %s, Exit status: %d',
+                        result.host, result.found, result.status)
+        missing = [result for result in results if not result.found]
+        if len(missing) == len(results):
+            logger.warning('%s on any vCenter', missing[0].message or
+                           'Objects are not found')
+    return exit_status(results)
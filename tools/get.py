@@ -1,74 +1,318 @@
+import re
+
 from pyVim import connect
 from pyVmomi import vmodl
 from pyVmomi import vim
+from pyVmomi import VmomiSupport
+
+from tools import pchelper
 
 __author__ = "h-mineta@0nyx.net"
 
-def _get_objects(content, vimtype):
-    container_view = content.viewManager.CreateContainerView(content.rootFolder, vimtype, True)
+def find_by_inventory_path(content, path):
+    # One server side lookup, e.g. 'DC1/host/Cluster1' or 'DC1/vm/Folder1'
+    return content.searchIndex.FindByInventoryPath(path.strip('/'))
+
+def get_scope(content, datacenter=None, cluster=None, folder=None):
+    # Smallest container to root the views of each type at, None meaning the
+    # root folder. cluster and folder are relative to the datacenter when it
+    # is given, full inventory paths otherwise.
+    # Returns None when one of them does not exist.
+    scope = {}
+    datacenter_ = None
+    if datacenter:
+        datacenter_ = find_by_inventory_path(content, datacenter)
+        if datacenter_ is None:
+            return None
+
+    cluster_ = None
+    if cluster:
+        if datacenter:
+            cluster = datacenter.strip('/') + '/host/' + cluster.strip('/')
+        cluster_ = find_by_inventory_path(content, cluster)
+        if cluster_ is None:
+            return None
+
+    folder_ = None
+    if folder:
+        if datacenter:
+            folder = datacenter.strip('/') + '/vm/' + folder.strip('/')
+        folder_ = find_by_inventory_path(content, folder)
+        if folder_ is None:
+            return None
+
+    scope[vim.VirtualMachine] = folder_ or cluster_ or datacenter_
+    scope[vim.HostSystem] = cluster_ or datacenter_
+    scope[vim.ResourcePool] = cluster_ or datacenter_
+    scope[vim.Datastore] = datacenter_
+    # SearchIndex only narrows searches to a datacenter
+    scope[vim.Datacenter] = datacenter_
+
+    return scope
+
+def get_scope_from_args(content, args):
+    return get_scope(content,
+                     getattr(args, 'datacenter', None),
+                     getattr(args, 'cluster', None),
+                     getattr(args, 'folder', None))
+
+def _get_objects(content, vimtype, container=None):
+    container_view = content.viewManager.CreateContainerView(container or content.rootFolder, vimtype, True)
     containers = container_view.view
     container_view.Destroy()
 
     return containers
 
-def _get_objects_by_names(content, vimtype, names):
+def _get_names(content, vimtype, container=None):
+    # Fetch only 'name' for every object in a single PropertyCollector call,
+    # instead of one round trip per managed object.
+    container_view = content.viewManager.CreateContainerView(container or content.rootFolder, vimtype, True)
+    try:
+        filter_spec = pchelper.build_filter_spec(container_view, vimtype, ['name'])
+        names = []
+        for obj in pchelper.retrieve_objects(content.propertyCollector, [filter_spec]):
+            for prop in obj.propSet:
+                if prop.name == 'name':
+                    names.append((obj.obj, prop.val))
+    finally:
+        container_view.Destroy()
+
+    return names
+
+def _get_objects_by_names(content, vimtype, names, index=None, container=None):
+    if isinstance(names, str):
+        names = [names]
+    names = set(names)
+
     objects = []
-    containers = _get_objects(content, vimtype)
-    for container in containers:
-        if container.name in names:
-            objects.append(container)
+    if index is not None:
+        objects, names = index.lookup(content, vimtype, names, container)
+        if not names:
+            return objects
+
+    pairs = _get_names(content, vimtype, container)
+    if index is not None:
+        index.store(content, vimtype, pairs, container)
+
+    for object_, name in pairs:
+        if name in names:
+            objects.append(object_)
 
     return objects
 
-def _get_name_by_object(content, vimtype, object_):
+def _get_name_by_object(content, vimtype, object_, container=None):
     name = None
-    containers = _get_objects(content, vimtype)
-    for container in containers:
-        if container == object_:
-            name = container.name
+    for container_, container_name in _get_names(content, vimtype, container):
+        if container_ == object_:
+            name = container_name
             break
 
     return name
 
-def get_vm_by_name(content, name):
-    objects = _get_objects_by_names(content, [vim.VirtualMachine], [name])
+def get_hosts(content, container=None):
+    return _get_objects(content, [vim.HostSystem], container)
+
+def get_vm_by_name(content, name, index=None, container=None):
+    objects = _get_objects_by_names(content, [vim.VirtualMachine], [name], index, container)
     if len(objects):
         return objects[0]
     else:
         return None
 
-def get_vms_by_names(content, names):
-    return _get_objects_by_names(content, [vim.VirtualMachine], names)
+def get_vms_by_names(content, names, index=None, container=None):
+    return _get_objects_by_names(content, [vim.VirtualMachine], names, index, container)
 
-def get_host_by_name(content, name):
-    objects = _get_objects_by_names(content, [vim.HostSystem], [name])
+def get_host_by_name(content, name, index=None, container=None):
+    objects = _get_objects_by_names(content, [vim.HostSystem], [name], index, container)
     if len(objects):
         return objects[0]
     else:
         return None
 
-def get_hosts_by_names(content, names):
-    return _get_objects_by_names(content, [vim.HostSystem], names)
+def get_hosts_by_names(content, names, index=None, container=None):
+    return _get_objects_by_names(content, [vim.HostSystem], names, index, container)
 
-def get_datastore_by_name(content, name):
-    objects = _get_objects_by_names(content, [vim.Datastore], [name])
+def get_datastore_by_name(content, name, index=None, container=None):
+    objects = _get_objects_by_names(content, [vim.Datastore], [name], index, container)
     if len(objects):
         return objects[0]
     else:
         return None
 
-def get_datastores_by_names(content, names):
-    return _get_objects_by_names(content, [vim.Datastore], names)
+def get_datastores_by_names(content, names, index=None, container=None):
+    return _get_objects_by_names(content, [vim.Datastore], names, index, container)
 
-def get_pool(content, identifer):
-    return get_pool_by_identifer(content, identifer)
+def _find_by_path(content, vimtype, path):
+    object_ = find_by_inventory_path(content, path)
+    if isinstance(object_, vimtype):
+        return object_
+    else:
+        return None
 
-def get_pool_by_identifer(content, identifer):
-    object_ = None
-    containers = _get_objects(content, [vim.ResourcePool])
-    for container in containers:
-        if str(container).strip('\'') == identifer:
-            object_ = container
-            break
+def _find_by_uuid(content, uuid, vm_search, datacenter=None):
+    # BIOS UUID first, then the vCenter instance UUID of VMs
+    object_ = content.searchIndex.FindByUuid(datacenter, uuid, vm_search)
+    if object_ is None and vm_search:
+        object_ = content.searchIndex.FindByUuid(datacenter, uuid, vm_search, True)
 
     return object_
+
+def get_vm_by_uuid(content, uuid, datacenter=None):
+    return _find_by_uuid(content, uuid, True, datacenter)
+
+def get_vms_by_dns_name(content, dns_name, datacenter=None):
+    return list(content.searchIndex.FindAllByDnsName(datacenter, dns_name, True))
+
+def get_vm_by_ip(content, ip, datacenter=None):
+    return content.searchIndex.FindByIp(datacenter, ip, True)
+
+def get_vm_by_path(content, path):
+    return _find_by_path(content, vim.VirtualMachine, path)
+
+def get_host_by_uuid(content, uuid, datacenter=None):
+    return _find_by_uuid(content, uuid, False, datacenter)
+
+def get_host_by_dns_name(content, dns_name, datacenter=None):
+    return content.searchIndex.FindByDnsName(datacenter, dns_name, False)
+
+def get_host_by_ip(content, ip, datacenter=None):
+    return content.searchIndex.FindByIp(datacenter, ip, False)
+
+def get_host_by_path(content, path):
+    return _find_by_path(content, vim.HostSystem, path)
+
+def get_vms_by_selectors(content, names=None, uuids=None, ips=None, paths=None, index=None, scope=None):
+    # UUIDs, IP addresses and inventory paths are resolved by SearchIndex
+    # with one call each, the inventory is only scanned for names.
+    scope = scope or {}
+    datacenter = scope.get(vim.Datacenter)
+
+    objects = []
+    for uuid in uuids or []:
+        objects.append(get_vm_by_uuid(content, uuid, datacenter))
+    for ip in ips or []:
+        objects.append(get_vm_by_ip(content, ip, datacenter))
+    for path in paths or []:
+        objects.append(get_vm_by_path(content, path))
+    if names:
+        objects.extend(get_vms_by_names(content, names, index, scope.get(vim.VirtualMachine)))
+
+    vms = []
+    for object_ in objects:
+        if object_ is not None and object_ not in vms:
+            vms.append(object_)
+
+    return vms
+
+def get_vm_placements(content, vms):
+    # host, datastores and cluster of every VM, with one call for the VMs and
+    # one for their hosts.
+    placements = {}
+    if not vms:
+        return placements
+
+    hosts = set()
+    list_view = content.viewManager.CreateListView(vms)
+    try:
+        filter_spec = pchelper.build_filter_spec(list_view, vim.VirtualMachine, ['runtime.host', 'datastore'])
+        for obj in pchelper.retrieve_objects(content.propertyCollector, [filter_spec]):
+            placement = {'host': None, 'datastore': [], 'cluster': None}
+            for prop in obj.propSet:
+                if prop.name == 'runtime.host':
+                    placement['host'] = prop.val
+                    hosts.add(prop.val)
+                else:
+                    placement['datastore'] = list(prop.val)
+            placements[obj.obj] = placement
+    finally:
+        list_view.Destroy()
+
+    clusters = {}
+    if hosts:
+        list_view = content.viewManager.CreateListView(list(hosts))
+        try:
+            filter_spec = pchelper.build_filter_spec(list_view, vim.HostSystem, ['parent'])
+            for obj in pchelper.retrieve_objects(content.propertyCollector, [filter_spec]):
+                for prop in obj.propSet:
+                    clusters[obj.obj] = prop.val
+        finally:
+            list_view.Destroy()
+
+    for placement in placements.values():
+        placement['cluster'] = clusters.get(placement['host'])
+
+    return placements
+
+def get_pool(content, identifer, container=None):
+    return get_pool_by_identifer(content, identifer, container)
+
+def _read_name(content, object_):
+    # Validates a MoRef built by hand with a single property read
+    filter_spec = vmodl.query.PropertyCollector.FilterSpec()
+    filter_spec.objectSet = [vmodl.query.PropertyCollector.ObjectSpec(obj=object_, skip=False)]
+    filter_spec.propSet = pchelper.get_property_specs(object_.__class__, ['name'])
+    try:
+        for obj in pchelper.retrieve_objects(content.propertyCollector, [filter_spec]):
+            for prop in obj.propSet:
+                return prop.val
+    except vmodl.fault.ManagedObjectNotFound:
+        pass
+
+    return None
+
+def _parse_pool_identifer(content, identifer):
+    # 'vim.ResourcePool:resgroup-10' (str() of a pool), 'resgroup-10'
+    # or 'resgroup-v10' (vApp)
+    match = re.match(r"^'?(?:(vim\.\w+):)?([\w-]+)'?$", identifer)
+    if match is None:
+        return None
+    class_name, moid = match.groups()
+    if class_name is None:
+        if not moid.startswith('resgroup-'):
+            return None
+        class_name = 'vim.VirtualApp' if moid.startswith('resgroup-v') else 'vim.ResourcePool'
+
+    try:
+        type_ = VmomiSupport.GetVmodlType(class_name)
+    except (AttributeError, KeyError):
+        return None
+    if not issubclass(type_, vim.ResourcePool):
+        return None
+
+    return type_(moid, content.propertyCollector._stub)
+
+def get_pool_by_path(content, path, container=None):
+    # path is 'Pool/SubPool' under the root pool of a cluster (container), or
+    # a full inventory path 'DC/host/Cluster/Resources/Pool/SubPool'
+    if isinstance(container, vim.ComputeResource):
+        object_ = container.resourcePool
+        for name in path.strip('/').split('/'):
+            if name == 'Resources' and object_ == container.resourcePool:
+                continue
+            object_ = content.searchIndex.FindChild(object_, name)
+            if object_ is None:
+                break
+    else:
+        object_ = find_by_inventory_path(content, path)
+
+    if isinstance(object_, vim.ResourcePool):
+        return object_
+    else:
+        return None
+
+def get_pool_by_identifer(content, identifer, container=None):
+    # MoRef: no enumeration, only the pool name is read to validate it
+    object_ = _parse_pool_identifer(content, identifer)
+    if object_ is not None and _read_name(content, object_) is not None:
+        return object_
+    # Not a MoRef, or not a valid one ('resgroup-foo' may be a pool name):
+    # look it up as a path or a name
+
+    if '/' in identifer or isinstance(container, vim.ComputeResource):
+        return get_pool_by_path(content, identifer, container)
+
+    objects = _get_objects_by_names(content, [vim.ResourcePool], [identifer], None, container)
+    if len(objects):
+        return objects[0]
+    else:
+        return None
@@ -0,0 +1,222 @@
+"""
+Persistent name to MoRef index for tools.get lookups.
+
+Every lookup by name in tools.get needs a full inventory scan. This module
+keeps the result of those scans in a small SQLite database keyed by the
+vCenter instance UUID, so a later invocation can resolve (type, name) to a
+managed object reference with an indexed query and a single property fetch
+to verify the reference is still valid.
+"""
+
+import os
+import sqlite3
+import time
+
+from pyVmomi import vmodl
+from pyVmomi import VmomiSupport
+
+from tools import pchelper
+
+DEFAULT_PATH = os.path.join(os.path.expanduser('~'), '.cache',
+                            'vmware-pyvmomi-tools', 'index.sqlite')
+DEFAULT_TTL = 3600
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS objects (
+    instance TEXT NOT NULL,
+    type     TEXT NOT NULL,
+    name     TEXT NOT NULL,
+    moid     TEXT NOT NULL,
+    class    TEXT NOT NULL,
+    updated  REAL NOT NULL,
+    PRIMARY KEY (instance, type, name, moid)
+)
+"""
+
+
+def _instance_key(content):
+    """
+    The vCenter instance UUID, or the endpoint address for standalone hosts
+    which do not report one.
+    """
+    about = content.about
+    if about.instanceUuid:
+        return about.instanceUuid
+    return 'host:' + content.propertyCollector._stub.host
+
+
+def _type_key(vimtype, container=None):
+    """
+    Lookups scoped to a container are kept apart from the unscoped ones, an
+    object found under the root folder may be outside the container.
+    """
+    key = ','.join(sorted(type_._wsdlName for type_ in vimtype))
+    if container is not None:
+        key += '@' + container._moId
+    return key
+
+
+class InventoryIndex(object):
+    """
+    An on-disk (type, name) -> MoRef index shared across invocations.
+    """
+
+    def __init__(self, path=DEFAULT_PATH, ttl=DEFAULT_TTL):
+        """
+        Opens (and creates if needed) the index database.
+
+        - `path` (str) is the SQLite database file.
+        - `ttl` (int) is the number of seconds an entry is trusted for.
+        """
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory, 0o700)
+
+        self.path = path
+        self.ttl = ttl
+        # Several cron jobs may share the same file.
+        self.connection = sqlite3.connect(path, timeout=30)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        with self.connection:
+            self.connection.execute(_SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def lookup(self, content, vimtype, names, container=None):
+        """
+        Resolves names through the index, within container if given.
+
+        Entries which are stale, point to a deleted object or to an object
+        which has been renamed are dropped.
+
+        Returns:
+            A tuple of the list of verified managed objects and the set of
+            names which could not be resolved.
+        """
+        instance = _instance_key(content)
+        type_key = _type_key(vimtype, container)
+        names = set(names)
+        if not names:
+            return [], names
+
+        placeholders = ','.join('?' * len(names))
+        rows = self.connection.execute(
+            'SELECT name, moid, class FROM objects'
+            ' WHERE instance = ? AND type = ? AND updated >= ?'
+            ' AND name IN (' + placeholders + ')',
+            [instance, type_key, time.time() - self.ttl] + list(names)
+        ).fetchall()
+
+        stub = content.propertyCollector._stub
+        candidates = {}
+        for name, moid, class_name in rows:
+            object_ = VmomiSupport.GetVmodlType(class_name)(moid, stub)
+            candidates[object_] = name
+
+        verified = self._verify(content, candidates)
+
+        objects = []
+        found = set()
+        for object_, name in candidates.items():
+            if verified.get(object_) == name:
+                objects.append(object_)
+                found.add(name)
+
+        stale = [object_ for object_ in candidates
+                 if verified.get(object_) != candidates[object_]]
+        if stale:
+            with self.connection:
+                self.connection.executemany(
+                    'DELETE FROM objects'
+                    ' WHERE instance = ? AND type = ? AND moid = ?',
+                    [(instance, type_key, object_._moId)
+                     for object_ in stale])
+
+        return objects, names - found
+
+    def _verify(self, content, candidates):
+        """
+        Reads 'name' of all candidate objects in one paged collection. Deleted
+        objects are left out of the result (and so invalidated by the
+        caller) instead of failing the whole batch.
+        """
+        remaining = list(candidates)
+        verified = {}
+        while remaining:
+            collector = vmodl.query.PropertyCollector
+            filter_spec = collector.FilterSpec()
+            filter_spec.objectSet = [
+                collector.ObjectSpec(obj=object_, skip=False)
+                for object_ in remaining]
+            filter_spec.propSet = pchelper.get_property_specs(
+                sorted(set(object_.__class__ for object_ in remaining),
+                       key=lambda type_: type_.__name__), ['name'])
+            # Missing objects come back with a missingSet
+            filter_spec.reportMissingObjectsInResults = True
+
+            try:
+                for obj in pchelper.retrieve_objects(
+                        content.propertyCollector, [filter_spec]):
+                    for prop in obj.propSet:
+                        if prop.name == 'name':
+                            verified[obj.obj] = prop.val
+            except vmodl.fault.ManagedObjectNotFound as ex:
+                # Servers not honouring reportMissingObjectsInResults:
+                # retry without the missing object
+                if ex.obj not in remaining:
+                    return verified
+                remaining = [object_ for object_ in remaining
+                             if object_ != ex.obj and
+                             object_ not in verified]
+                continue
+            break
+
+        return verified
+
+    def store(self, content, vimtype, pairs, container=None):
+        """
+        Replaces the entries for vimtype (within container if given) with the
+        (object, name) pairs of a full inventory scan.
+        """
+        instance = _instance_key(content)
+        type_key = _type_key(vimtype, container)
+        now = time.time()
+        with self.connection:
+            self.connection.execute(
+                'DELETE FROM objects WHERE instance = ? AND type = ?',
+                (instance, type_key))
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO objects VALUES (?, ?, ?, ?, ?, ?)',
+                [(instance, type_key, name, object_._moId,
+                  object_.__class__.__name__, now)
+                 for object_, name in pairs])
+
+    def invalidate(self, content=None, vimtype=None):
+        """
+        Drops entries for one vCenter (and optionally one type), or the whole
+        index when no content is given.
+        """
+        with self.connection:
+            if content is None:
+                self.connection.execute('DELETE FROM objects')
+            elif vimtype is None:
+                self.connection.execute(
+                    'DELETE FROM objects WHERE instance = ?',
+                    (_instance_key(content),))
+            else:
+                self.connection.execute(
+                    'DELETE FROM objects WHERE instance = ? AND type = ?',
+                    (_instance_key(content), _type_key(vimtype)))
+
+
+def from_args(args):
+    """
+    Opens the index requested on the command line, if any.
+
+    Returns:
+        An InventoryIndex or None
+    """
+    if not getattr(args, 'index_file', None):
+        return None
+    return InventoryIndex(args.index_file, args.index_ttl)
@@ -0,0 +1,262 @@
+"""
+In-memory inventory mirror kept current by the Property Collector.
+
+One full snapshot of the configured object types and properties is taken
+when the mirror starts, afterwards only the changes reported by
+WaitForUpdatesEx are applied. Lookups are served from local dictionaries
+and cost nothing on the vCenter side no matter how often they happen.
+
+Usage:
+    inventory = Inventory(service_instance)
+    inventory.start()
+    vms = get.get_vms_by_names(content, ['vm01'], inventory)
+    inventory.update(max_wait_seconds=0)
+"""
+
+import logging
+import threading
+
+from pyVmomi import vim
+from pyVmomi import vmodl
+
+from tools import pchelper
+
+DEFAULT_PROPERTIES = {
+    vim.VirtualMachine: ['name', 'runtime.powerState', 'runtime.host'],
+    vim.HostSystem: ['name'],
+    vim.Datastore: ['name'],
+    vim.ResourcePool: ['name'],
+}
+
+
+class Inventory(object):
+    """
+    A local mirror of managed object properties.
+    """
+
+    def __init__(self, service_instance, properties=None, container=None):
+        """
+        - `service_instance` is the ServiceInstance connection.
+        - `properties` (dict) maps managed object types to the list of
+          property paths to mirror. Defaults to DEFAULT_PROPERTIES.
+        - `container` is the folder, datacenter or cluster to mirror. Defaults
+          to the root folder.
+        """
+        self.service_instance = service_instance
+        self.properties = properties or DEFAULT_PROPERTIES
+        self.container = container
+        self.version = None
+        # Set when the background updates failed: the mirror is no longer
+        # current and lookups fall back to a scan
+        self.stale = False
+
+        self._lock = threading.RLock()
+        self._objects = {}
+        self._names = {}
+        self._view = None
+        self._collector = None
+        self._filter = None
+        self._thread = None
+        self._stop = threading.Event()
+
+    def start(self):
+        """
+        Creates the property filter and loads the initial snapshot.
+        """
+        types = list(self.properties)
+        self._view = pchelper.get_container_view(self.service_instance,
+                                                 types, self.container)
+
+        filter_spec = pchelper.build_filter_spec(self._view, types)
+        filter_spec.propSet = [
+            spec for type_, path_set in self.properties.items()
+            for spec in pchelper.get_property_specs(type_, path_set)]
+
+        # A private collector, so other filters on the session do not see
+        # (and consume) the mirror updates.
+        self._collector = self.service_instance.content.propertyCollector \
+            .CreatePropertyCollector()
+        self._filter = self._collector.CreateFilter(filter_spec, False)
+
+        # The first call returns every object as 'enter'. It may be split in
+        # several truncated updates.
+        while True:
+            update = self._wait(0)
+            if update is None or not update.truncated:
+                break
+
+    def stop(self):
+        """
+        Stops the background thread and destroys the server side objects.
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._collector.CancelWaitForUpdates()
+            self._thread.join()
+            self._thread = None
+
+        if self._filter is not None:
+            self._filter = None
+            self._collector.DestroyPropertyCollector()
+        if self._view is not None:
+            self._view.Destroy()
+            self._view = None
+
+    def update(self, max_wait_seconds=0):
+        """
+        Applies pending changes, waiting up to max_wait_seconds for some.
+
+        Returns:
+            The number of objects which changed
+        """
+        changed = 0
+        while True:
+            update = self._wait(max_wait_seconds)
+            if update is None:
+                break
+            changed += sum(len(filter_set.objectSet)
+                           for filter_set in update.filterSet)
+            if not update.truncated:
+                break
+            max_wait_seconds = 0
+
+        return changed
+
+    def start_background(self, max_wait_seconds=30):
+        """
+        Keeps the mirror current from a daemon thread.
+        """
+        if self._filter is None:
+            self.start()
+
+        def loop():
+            while not self._stop.is_set():
+                try:
+                    self.update(max_wait_seconds)
+                except vmodl.fault.RequestCanceled:
+                    if self._stop.is_set():
+                        break
+                    logging.error('Inventory updates canceled, the mirror '
+                                  'is stale')
+                    self.stale = True
+                    break
+                except vmodl.MethodFault as ex:
+                    logging.error('Inventory updates failed, the mirror is '
+                                  'stale: %s', ex.msg or type(ex).__name__)
+                    self.stale = True
+                    break
+                except Exception as ex:
+                    logging.error('Inventory updates failed, the mirror is '
+                                  'stale: %s', ex)
+                    self.stale = True
+                    break
+
+        self._stop.clear()
+        self.stale = False
+        self._thread = threading.Thread(target=loop, name='inventory')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _wait(self, max_wait_seconds):
+        options = vmodl.query.PropertyCollector.WaitOptions()
+        options.maxWaitSeconds = max_wait_seconds
+        update = self._collector.WaitForUpdatesEx(self.version, options)
+        if update is None:
+            return None
+
+        with self._lock:
+            for filter_set in update.filterSet:
+                for obj_set in filter_set.objectSet:
+                    self._apply(obj_set)
+            self.version = update.version
+
+        return update
+
+    def _apply(self, obj_set):
+        object_ = obj_set.obj
+        if obj_set.kind == 'leave':
+            properties = self._objects.pop(object_, {})
+            self._unindex(object_, properties.get('name'))
+            return
+
+        properties = self._objects.setdefault(object_, {})
+        for change in obj_set.changeSet:
+            if change.name == 'name':
+                self._unindex(object_, properties.get('name'))
+
+            if change.op in ('remove', 'indirectRemove'):
+                properties.pop(change.name, None)
+            else:
+                properties[change.name] = change.val
+
+            if change.name == 'name' and change.op == 'assign':
+                self._names.setdefault(change.val, set()).add(object_)
+
+    def _unindex(self, object_, name):
+        if name is None:
+            return
+        objects = self._names.get(name)
+        if objects:
+            objects.discard(object_)
+
+    def find(self, vimtype, name):
+        """
+        Returns the mirrored objects of the given types named name.
+        """
+        with self._lock:
+            return [object_ for object_ in self._names.get(name, ())
+                    if isinstance(object_, tuple(vimtype))]
+
+    def get_properties(self, object_):
+        """
+        Returns a copy of the mirrored properties of a managed object, or
+        None if it is not mirrored.
+        """
+        with self._lock:
+            properties = self._objects.get(object_)
+            if properties is None:
+                return None
+            properties = dict(properties)
+        properties['obj'] = object_
+        return properties
+
+    def get_objects(self, vimtype):
+        """
+        Returns the mirrored properties of every object of the given types.
+        """
+        with self._lock:
+            return [dict(properties, obj=object_)
+                    for object_, properties in self._objects.items()
+                    if isinstance(object_, tuple(vimtype))]
+
+    def lookup(self, content, vimtype, names, container=None):
+        """
+        tools.get index interface. Types which are not mirrored, or mirrored
+        without 'name', and lookups scoped to another container than the
+        mirrored one are reported as missing so tools.get falls back to a
+        scan. So is everything once the mirror is stale.
+        """
+        names = set(names)
+        if self.stale:
+            return [], names
+        if container is not None and container != self.container:
+            return [], names
+        if any(type_ not in self.properties
+               or 'name' not in self.properties[type_] for type_ in vimtype):
+            return [], names
+
+        objects = []
+        found = set()
+        for name in names:
+            matches = self.find(vimtype, name)
+            if matches:
+                objects.extend(matches)
+                found.add(name)
+
+        return objects, names - found
+
+    def store(self, content, vimtype, pairs, container=None):
+        """
+        Nothing to do, the mirror is maintained from the update stream.
+        """
+        pass
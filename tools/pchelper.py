@@ -2,13 +2,126 @@
 Property Collector helper module.
 """
 
+import collections
+import re
+
 import pyVmomi
 
+from tools import serviceutil
+
+
+# Specs which only depend on the view type, object types and paths are built
+# once and shared by every filter. They must not be modified: callers get new
+# lists holding them.
+_SPEC_CACHE = {}
+
+
+def _cached_spec(key, build):
+    spec = _SPEC_CACHE.get(key)
+    if spec is None:
+        spec = _SPEC_CACHE.setdefault(key, build())
+    return spec
+
+
+def clear_spec_cache():
+    """
+    Drop the prebuilt specs, they are rebuilt on next use
+    """
+    _SPEC_CACHE.clear()
+
+
+def _build_view_traversal(view_type):
+    traversal_spec = pyVmomi.vmodl.query.PropertyCollector.TraversalSpec()
+    traversal_spec.name = 'traverseEntities'
+    traversal_spec.path = 'view'
+    traversal_spec.skip = False
+    traversal_spec.type = view_type
+    return traversal_spec
+
+
+def _build_property_specs(obj_type, path_set):
+    property_specs = []
+    for type_ in obj_type:
+        property_spec = pyVmomi.vmodl.query.PropertyCollector.PropertySpec()
+        property_spec.type = type_
+
+        if not path_set:
+            property_spec.all = True
+
+        property_spec.pathSet = list(path_set or [])
+        property_specs.append(property_spec)
+    return property_specs
+
+
+def get_property_specs(obj_type, path_set=None):
+    """
+    Property specifications selecting the given properties of the given
+    types, built once per (types, paths) and reused
+
+    Args:
+        obj_type      (pyVmomi.vim.*): Type (or list of types) of managed
+                                       object
+        path_set               (list): List of properties to retrieve, all
+                                       of them if empty
+
+    Returns:
+        A new list of shared vmodl.query.PropertyCollector.PropertySpec
+
+    """
+    if not isinstance(obj_type, (list, tuple)):
+        obj_type = [obj_type]
+    obj_type = tuple(obj_type)
+    path_set = tuple(path_set or ())
+
+    return list(_cached_spec(
+        ('properties', obj_type, path_set),
+        lambda: _build_property_specs(obj_type, path_set)))
+
+
+def build_filter_spec(view_ref, obj_type, path_set=None):
+    """
+    Build a property filter specification which traverses a view ref and
+    selects the given properties of the objects found there
+
+    The traversal and property specifications are shared between calls with
+    the same view type, object types and path set, only the object and
+    filter specifications are new.
+
+    Args:
+        view_ref (pyVmomi.vim.view.*): Starting point of inventory navigation
+        obj_type      (pyVmomi.vim.*): Type (or list of types) of managed
+                                       object
+        path_set               (list): List of properties to retrieve
+
+    Returns:
+        A vmodl.query.PropertyCollector.FilterSpec
+
+    """
+    view_type = view_ref.__class__
+    traversal_spec = _cached_spec(('view', view_type),
+                                  lambda: _build_view_traversal(view_type))
+
+    # Create object specification to define the starting point of
+    # inventory navigation
+    obj_spec = pyVmomi.vmodl.query.PropertyCollector.ObjectSpec()
+    obj_spec.obj = view_ref
+    obj_spec.skip = True
+    obj_spec.selectSet = [traversal_spec]
+
+    # Add the object and property specification to the
+    # property filter specification
+    filter_spec = pyVmomi.vmodl.query.PropertyCollector.FilterSpec()
+    filter_spec.objectSet = [obj_spec]
+    filter_spec.propSet = get_property_specs(obj_type, path_set)
+
+    return filter_spec
+
 
 # Shamelessly borrowed from:
 # https://github.com/dnaeon/py-vconnector/blob/master/src/vconnector/core.py
 def collect_properties(service_instance, view_ref, obj_type, path_set=None,
-                       include_mors=False):
+                       include_mors=False, record_type=None,
+                       intern_paths=None):
     """
     Collect properties for managed objects from a view ref
 
@@ -24,56 +137,342 @@ def collect_properties(service_instance, view_ref, obj_type, path_set=None,
         path_set               (list): List of properties to retrieve
         include_mors           (bool): If True include the managed objects
                                        refs in the result
+        record_type            (type): Return compact rows, see
+                                       iter_properties
+        intern_paths           (list): Properties whose equal values share
+                                       one instance, True for all
 
     Returns:
         A list of properties for the managed objects
 
+    """
+    return list(iter_properties(service_instance, view_ref, obj_type,
+                                path_set, include_mors,
+                                record_type=record_type,
+                                intern_paths=intern_paths))
+
+
+def retrieve_objects(collector, filter_specs, max_objects=None):
+    """
+    Retrieve the ObjectContent of filter specs page by page with
+    RetrievePropertiesEx and ContinueRetrievePropertiesEx
+
+    Args:
+        collector (PropertyCollector): Property collector to use
+        filter_specs           (list): FilterSpecs to retrieve
+        max_objects             (int): Maximum number of objects per page,
+                                       None lets the server decide
+
+    Returns:
+        A generator of vmodl.query.PropertyCollector.ObjectContent
+
+    """
+    options = pyVmomi.vmodl.query.PropertyCollector.RetrieveOptions()
+    if max_objects:
+        options.maxObjects = max_objects
+
+    result = collector.RetrievePropertiesEx(filter_specs, options)
+    token = None
+    try:
+        while result is not None:
+            token = result.token
+            for obj in result.objects:
+                yield obj
+
+            if token is None:
+                break
+            result = collector.ContinueRetrievePropertiesEx(token)
+            token = None
+    finally:
+        # Release the server side result set if the caller stopped early
+        if token is not None:
+            collector.CancelRetrievePropertiesEx(token)
+
+
+def _to_properties(obj, include_mors):
+    properties = {}
+    for prop in obj.propSet:
+        properties[prop.name] = prop.val
+
+    if include_mors:
+        properties['obj'] = obj.obj
+
+    return properties
+
+
+def make_record_type(path_set, include_mors=False, name='Record'):
+    """
+    Build a compact row type for a path set: a namedtuple whose fields are
+    the property paths with every non identifier character replaced by '_'
+    ('runtime.powerState' -> runtime_powerState), plus 'obj' if include_mors
+
+    The schema is derived once, rows then cost one tuple each instead of a
+    dict with a key string per property.
+
+    Args:
+        path_set     (list): List of properties of the rows
+        include_mors (bool): If True add the 'obj' field
+        name          (str): Name of the generated type
+
+    Returns:
+        A namedtuple type, with the original paths in its _paths attribute
+
+    """
+    if not path_set:
+        raise ValueError("record rows need an explicit path_set")
+
+    fields = [re.sub(r'\W', '_', path) for path in path_set]
+    if include_mors:
+        fields.append('obj')
+
+    record_type = collections.namedtuple(name, fields)
+    record_type._paths = tuple(path_set)
+    return record_type
+
+
+class _Interner(object):
+    """
+    Shares one instance of equal property values (power states, guest OS
+    names, host refs...) within a column.
+    """
+
+    def __init__(self, paths):
+        self._tables = dict((path, {}) for path in paths)
+
+    def __call__(self, path, value):
+        table = self._tables.get(path)
+        if table is None:
+            return value
+        try:
+            return table.setdefault(value, value)
+        except TypeError:
+            # Unhashable data object
+            return value
+
+
+def iter_properties(service_instance, view_ref, obj_type, path_set=None,
+                    include_mors=False, max_objects=None, record_type=None,
+                    intern_paths=None):
+    """
+    Collect properties for managed objects from a view ref, yielding them as
+    the pages of the result arrive so large inventories are processed in
+    constant memory
+
+    Args:
+        si          (ServiceInstance): ServiceInstance connection
+        view_ref (pyVmomi.vim.view.*): Starting point of inventory navigation
+        obj_type      (pyVmomi.vim.*): Type of managed object
+        path_set               (list): List of properties to retrieve
+        include_mors           (bool): If True include the managed objects
+                                       refs in the result
+        max_objects             (int): Maximum number of objects per page
+        record_type            (type): Yield rows of this make_record_type()
+                                       type instead of dicts. Built from
+                                       path_set and include_mors if True
+        intern_paths           (list): Properties whose equal values share
+                                       one instance, True for all
+
+    Returns:
+        A generator of the properties of each managed object
+
     """
     collector = service_instance.content.propertyCollector
+    filter_spec = build_filter_spec(view_ref, obj_type, path_set)
 
-    # Create object specification to define the starting point of
-    # inventory navigation
-    obj_spec = pyVmomi.vmodl.query.PropertyCollector.ObjectSpec()
-    obj_spec.obj = view_ref
-    obj_spec.skip = True
+    if record_type is True:
+        record_type = make_record_type(path_set, include_mors)
+    if intern_paths is True:
+        intern_paths = path_set or []
+    intern = _Interner(intern_paths or [])
 
-    # Create a traversal specification to identify the path for collection
-    traversal_spec = pyVmomi.vmodl.query.PropertyCollector.TraversalSpec()
-    traversal_spec.name = 'traverseEntities'
-    traversal_spec.path = 'view'
-    traversal_spec.skip = False
-    traversal_spec.type = view_ref.__class__
-    obj_spec.selectSet = [traversal_spec]
+    objects = retrieve_objects(collector, [filter_spec], max_objects)
+    if record_type is None:
+        for obj in objects:
+            properties = _to_properties(obj, include_mors)
+            if intern_paths:
+                for path in properties:
+                    properties[path] = intern(path, properties[path])
+            yield properties
+        return
+
+    positions = dict((path, index)
+                     for index, path in enumerate(record_type._paths))
+    size = len(record_type._fields)
+    for obj in objects:
+        values = [None] * size
+        for prop in obj.propSet:
+            index = positions.get(prop.name)
+            if index is not None:
+                values[index] = intern(prop.name, prop.val)
+        if size > len(positions):
+            values[-1] = obj.obj
+        yield record_type._make(values)
+
+
+def collect_columns(service_instance, view_ref, obj_type, path_set,
+                    include_mors=False, max_objects=None, intern_paths=True):
+    """
+    Collect properties column-oriented: one list per property, all in the
+    same object order, with repeated values interned by default
+
+    Args:
+        si          (ServiceInstance): ServiceInstance connection
+        view_ref (pyVmomi.vim.view.*): Starting point of inventory navigation
+        obj_type      (pyVmomi.vim.*): Type of managed object
+        path_set               (list): List of properties to retrieve
+        include_mors           (bool): If True add an 'obj' column
+        max_objects             (int): Maximum number of objects per page
+        intern_paths           (list): Properties whose equal values share
+                                       one instance, True for all
 
-    # Identify the properties to the retrieved
-    property_spec = pyVmomi.vmodl.query.PropertyCollector.PropertySpec()
-    property_spec.type = obj_type
+    Returns:
+        A dict of property path to list of values
 
+    """
     if not path_set:
-        property_spec.all = True
+        raise ValueError("columns need an explicit path_set")
 
-    property_spec.pathSet = path_set
+    paths = list(path_set)
+    if include_mors:
+        paths.append('obj')
+    columns = dict((path, []) for path in paths)
+    appends = [columns[path].append for path in paths]
+
+    for row in iter_properties(service_instance, view_ref, obj_type,
+                               path_set, include_mors, max_objects,
+                               record_type=True, intern_paths=intern_paths):
+        for append, value in zip(appends, row):
+            append(value)
+
+    return columns
+
+
+def collect_object_properties(service_instance, objects, obj_type,
+                              path_set=None, include_mors=False):
+    """
+    Collect properties for a known list of managed objects in one property
+    collection, without creating a view
+
+    Args:
+        si          (ServiceInstance): ServiceInstance connection
+        objects                (list): Managed objects to read
+        obj_type      (pyVmomi.vim.*): Type (or list of types) of managed
+                                       object
+        path_set               (list): List of properties to retrieve
+        include_mors           (bool): If True include the managed objects
+                                       refs in the result
+
+    Returns:
+        A list of properties for the managed objects
+
+    """
+    if not objects:
+        return []
+
+    collector = service_instance.content.propertyCollector
 
-    # Add the object and property specification to the
-    # property filter specification
     filter_spec = pyVmomi.vmodl.query.PropertyCollector.FilterSpec()
-    filter_spec.objectSet = [obj_spec]
-    filter_spec.propSet = [property_spec]
+    filter_spec.objectSet = [
+        pyVmomi.vmodl.query.PropertyCollector.ObjectSpec(obj=obj, skip=False)
+        for obj in objects]
+    filter_spec.propSet = get_property_specs(obj_type, path_set)
 
-    # Retrieve properties
-    props = collector.RetrieveContents([filter_spec])
+    return [_to_properties(obj, include_mors)
+            for obj in retrieve_objects(collector, [filter_spec])]
 
-    data = []
-    for obj in props:
-        properties = {}
-        for prop in obj.propSet:
-            properties[prop.name] = prop.val
 
-        if include_mors:
-            properties['obj'] = obj.obj
+# Result of snapshot_inventory: objects maps each requested type to an
+# ordered dict of managed object to properties, parents maps every object
+# to its parent and children each parent to the list of its children
+InventorySnapshot = collections.namedtuple('InventorySnapshot',
+                                           ['objects', 'parents', 'children'])
+
+
+def build_traversal_filter_spec(container, types, path_set=None):
+    """
+    Build a property filter specification which walks the whole inventory
+    under container with the full traversal spec
+
+    Args:
+        container    (ManagedEntity): Starting point, usually the root folder
+        types                 (list): Types of managed object to select
+        path_set       (list / dict): List of properties to retrieve for all
+                                      types, or dict of type to list
+
+    Returns:
+        A vmodl.query.PropertyCollector.FilterSpec
+
+    """
+    collector = pyVmomi.vmodl.query.PropertyCollector
+
+    filter_spec = collector.FilterSpec()
+    filter_spec.objectSet = [collector.ObjectSpec(
+        obj=container, skip=False,
+        selectSet=_cached_spec(('full',), serviceutil.build_full_traversal))]
+
+    property_specs = []
+    for type_ in types:
+        paths = path_set
+        if isinstance(path_set, dict):
+            paths = path_set.get(type_)
+        property_specs.extend(get_property_specs(type_, paths))
+    filter_spec.propSet = property_specs
+
+    return filter_spec
+
+
+def snapshot_inventory(service_instance, types, path_set=None,
+                       container=None, max_objects=None):
+    """
+    Collect the properties of objects of several types in one traversal of
+    the inventory, instead of one container view and collection per type.
+    The parent of every object is collected too, giving the parent / child
+    relations of the result.
+
+    Args:
+        si          (ServiceInstance): ServiceInstance connection
+        types                  (list): Types of managed object
+        path_set        (list / dict): List of properties to retrieve for all
+                                       types, or dict of type to list
+        container     (ManagedEntity): Starting point of the traversal, the
+                                       root folder by default
+        max_objects             (int): Maximum number of objects per page
+
+    Returns:
+        An InventorySnapshot
+
+    """
+    types = list(types)
+    if isinstance(path_set, dict):
+        paths = dict((type_, list(path_set.get(type_) or []))
+                     for type_ in types)
+    else:
+        paths = dict((type_, list(path_set or [])) for type_ in types)
+    for type_paths in paths.values():
+        if type_paths and 'parent' not in type_paths:
+            type_paths.append('parent')
+
+    filter_spec = build_traversal_filter_spec(
+        container or service_instance.content.rootFolder, types, paths)
+
+    objects = collections.OrderedDict(
+        (type_, collections.OrderedDict()) for type_ in types)
+    parents = {}
+    children = collections.defaultdict(list)
+    for obj in retrieve_objects(service_instance.content.propertyCollector,
+                                [filter_spec], max_objects):
+        properties = _to_properties(obj, False)
+        for type_ in types:
+            if isinstance(obj.obj, type_):
+                objects[type_][obj.obj] = properties
+                break
+
+        parent = properties.get('parent')
+        parents[obj.obj] = parent
+        if parent is not None:
+            children[parent].append(obj.obj)
 
-        data.append(properties)
-    return data
+    return InventorySnapshot(objects, parents, dict(children))
 
 
 def get_container_view(service_instance, obj_type, container=None):
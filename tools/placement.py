@@ -0,0 +1,260 @@
+"""
+Balanced placement of virtual machines on candidate hosts and datastores.
+
+The usage of the candidates and the demand of the virtual machines are read
+with one property collection. VMs are then assigned largest first, each to
+the candidate which stays the least loaded once the VM is added, without
+going over the capacity limits. The resulting moves are meant to be run
+through tools.tasks.TaskScheduler.
+
+Usage:
+    planner = placement.Planner(SI, hosts, datastores, max_host_usage=0.8)
+    moves, unplaced = planner.plan(vms)
+"""
+
+import collections
+
+from pyVmomi import vim
+from pyVmomi import vmodl
+
+from tools import pchelper
+
+HOST_PATHS = [
+    'name',
+    'summary.hardware.cpuMhz',
+    'summary.hardware.numCpuCores',
+    'summary.hardware.memorySize',
+    'summary.quickStats.overallCpuUsage',
+    'summary.quickStats.overallMemoryUsage',
+    'runtime.connectionState',
+    'runtime.inMaintenanceMode',
+]
+
+DATASTORE_PATHS = [
+    'name',
+    'summary.capacity',
+    'summary.freeSpace',
+    'summary.accessible',
+]
+
+VM_PATHS = [
+    'name',
+    'runtime.host',
+    'runtime.powerState',
+    'config.hardware.memoryMB',
+    'summary.quickStats.overallCpuUsage',
+    'summary.storage.committed',
+    'datastore',
+]
+
+MB = 1024 * 1024
+
+# host and datastore are None when the VM stays where it is
+Move = collections.namedtuple('Move', ['vm', 'name', 'host', 'datastore'])
+
+
+def collect_usage(service_instance, hosts, datastores, vms):
+    """
+    Reads HOST_PATHS, DATASTORE_PATHS and VM_PATHS of all objects in a
+    single property collection.
+
+    Returns:
+        A dict of managed object to dict of property path to value
+    """
+    collector = vmodl.query.PropertyCollector
+    filter_spec = collector.FilterSpec()
+    filter_spec.objectSet = [collector.ObjectSpec(obj=obj, skip=False)
+                             for obj in list(hosts) + list(datastores) +
+                             list(vms)]
+    filter_spec.propSet = \
+        pchelper.get_property_specs(vim.HostSystem, HOST_PATHS) + \
+        pchelper.get_property_specs(vim.Datastore, DATASTORE_PATHS) + \
+        pchelper.get_property_specs(vim.VirtualMachine, VM_PATHS)
+
+    usage = {}
+    if not filter_spec.objectSet:
+        return usage
+
+    for obj in pchelper.retrieve_objects(
+            service_instance.content.propertyCollector, [filter_spec]):
+        usage[obj.obj] = dict((prop.name, prop.val) for prop in obj.propSet)
+    return usage
+
+
+class _Bin(object):
+    """
+    Capacity and projected usage of one candidate.
+    """
+
+    def __init__(self, obj, name, capacity, used):
+        self.obj = obj
+        self.name = name
+        self.capacity = capacity
+        self.used = used
+        self.count = 0
+
+    def ratios(self, demand):
+        return [(used + extra) / float(capacity) if capacity else 1.0
+                for used, extra, capacity in zip(self.used, demand,
+                                                 self.capacity)]
+
+    def add(self, demand):
+        self.used = [used + extra for used, extra in zip(self.used, demand)]
+        self.count += 1
+
+
+def _best(bins, demand, limit):
+    """
+    The bin which is the least loaded (on its most loaded dimension) once
+    demand is added, among those staying under limit.
+    """
+    best = None
+    best_key = None
+    for bin_ in bins:
+        ratios = bin_.ratios(demand)
+        if max(ratios) > limit:
+            continue
+        key = (max(ratios), sum(ratios), bin_.count)
+        if best is None or key < best_key:
+            best = bin_
+            best_key = key
+    return best
+
+
+class Planner(object):
+    """
+    Computes balanced vMotion destinations for a set of virtual machines.
+    """
+
+    def __init__(self, service_instance, hosts, datastores=None,
+                 max_host_usage=0.9, max_datastore_usage=0.9):
+        """
+        - `hosts` (list) are the candidate vim.HostSystem, none to keep the
+          VMs on their host.
+        - `datastores` (list) are the candidate vim.Datastore, none to keep
+          the VMs storage where it is.
+        - `max_host_usage` (float) is the CPU and memory usage ratio no
+          host may go over.
+        - `max_datastore_usage` (float) is the used space ratio no datastore
+          may go over.
+        """
+        self.service_instance = service_instance
+        self.hosts = list(hosts)
+        self.datastores = list(datastores or [])
+        self.max_host_usage = max_host_usage
+        self.max_datastore_usage = max_datastore_usage
+        # Names of the VMs and candidates read by the last plan()
+        self.names = {}
+
+    def _host_bins(self, usage):
+        bins = []
+        for host in self.hosts:
+            props = usage.get(host, {})
+            if props.get('runtime.connectionState') != 'connected' or \
+                    props.get('runtime.inMaintenanceMode'):
+                continue
+            cpu = (props.get('summary.hardware.cpuMhz') or 0) * \
+                (props.get('summary.hardware.numCpuCores') or 0)
+            memory = (props.get('summary.hardware.memorySize') or 0) // MB
+            bins.append(_Bin(host, props.get('name'), [cpu, memory], [
+                props.get('summary.quickStats.overallCpuUsage') or 0,
+                props.get('summary.quickStats.overallMemoryUsage') or 0]))
+        return bins
+
+    def _datastore_bins(self, usage):
+        bins = []
+        for datastore in self.datastores:
+            props = usage.get(datastore, {})
+            if not props.get('summary.accessible'):
+                continue
+            capacity = props.get('summary.capacity') or 0
+            bins.append(_Bin(datastore, props.get('name'), [capacity],
+                             [capacity - (props.get('summary.freeSpace') or 0)]))
+        return bins
+
+    def plan(self, vms):
+        """
+        Returns:
+            A tuple of the list of Move, and the list of the VMs which do
+            not fit on any candidate
+        """
+        usage = collect_usage(self.service_instance, self.hosts,
+                              self.datastores, vms)
+        self.names = dict((obj, props.get('name'))
+                          for obj, props in usage.items())
+        hosts = self._host_bins(usage)
+        datastores = self._datastore_bins(usage)
+        by_host = dict((bin_.obj, bin_) for bin_ in hosts)
+        by_datastore = dict((bin_.obj, bin_) for bin_ in datastores)
+
+        demands = []
+        for vm in vms:
+            props = usage.get(vm, {})
+            if props.get('runtime.powerState') == 'poweredOn':
+                demand = [props.get('summary.quickStats.overallCpuUsage') or 0,
+                          props.get('config.hardware.memoryMB') or 0]
+            else:
+                # Cold migration, the VM uses no host resources
+                demand = [0, 0]
+            demands.append((vm, props, demand))
+
+        # VMs already on a candidate leave their share of its usage to the
+        # others before being placed again
+        for vm, props, demand in demands:
+            current = by_host.get(props.get('runtime.host'))
+            if current is not None:
+                current.used = [used - extra for used, extra
+                                in zip(current.used, demand)]
+            storage = props.get('summary.storage.committed') or 0
+            for datastore in props.get('datastore') or []:
+                if datastore in by_datastore:
+                    by_datastore[datastore].used[0] -= storage
+
+        # Largest first, the classic first fit decreasing order
+        demands.sort(key=lambda item: (item[2][1], item[2][0]), reverse=True)
+
+        moves = []
+        unplaced = []
+        for vm, props, demand in demands:
+            storage = props.get('summary.storage.committed') or 0
+            current_datastores = props.get('datastore') or []
+            # Storage only moves when the VM is not on the candidates already
+            move_storage = datastores and not all(
+                datastore_ in by_datastore for datastore_ in current_datastores)
+
+            host = None
+            if self.hosts:
+                host = _best(hosts, demand, self.max_host_usage)
+            datastore = None
+            if move_storage:
+                datastore = _best(datastores, [storage],
+                                  self.max_datastore_usage)
+
+            if (self.hosts and host is None) or \
+                    (move_storage and datastore is None):
+                # Stays where it is, with its share of the usage
+                host = by_host.get(props.get('runtime.host'))
+                if host is not None:
+                    host.add(demand)
+                for datastore_ in current_datastores:
+                    if datastore_ in by_datastore:
+                        by_datastore[datastore_].add([storage])
+                unplaced.append(vm)
+                continue
+
+            if host is not None:
+                host.add(demand)
+                if host.obj == props.get('runtime.host'):
+                    host = None
+            if datastore is not None:
+                datastore.add([storage])
+            elif datastores:
+                for datastore_ in current_datastores:
+                    by_datastore[datastore_].add([storage])
+
+            moves.append(Move(
+                vm, props.get('name'),
+                host.obj if host is not None else None,
+                datastore.obj if datastore is not None else None))
+
+        return moves, unplaced
@@ -0,0 +1,264 @@
+"""
+Concurrent power operations on many virtual machines.
+
+The SOAP calls are issued from a bounded thread pool driven by asyncio.
+Completion is confirmed from a property filter on the virtual machines
+(runtime.powerState, and runtime.bootTime for reboots) and on the tasks
+started, instead of polling each VM. Guest operations which do not complete
+in time can fall back to the equivalent hard operation.
+
+Usage:
+    results = power.run_power_operations(SI, vms, 'shutdown', parallel=16,
+                                         timeout=300, hard_fallback=True)
+"""
+
+import asyncio
+import collections
+import concurrent.futures
+import logging
+import threading
+
+from pyVmomi import vim
+from pyVmomi import vmodl
+
+from tools import pchelper
+
+VM_PATHS = ['name', 'runtime.powerState', 'runtime.bootTime']
+TASK_PATHS = ['info.state', 'info.error']
+
+# Longest wait of one WaitForUpdatesEx call of the watcher. The wait returns
+# as soon as something changes, and close() cancels it.
+MAX_WAIT_SECONDS = 60
+
+Operation = collections.namedtuple('Operation', ['method', 'done', 'fallback'])
+
+
+def _powered(state):
+    return lambda before, now: now.get('runtime.powerState') == state
+
+
+def _rebooted(before, now):
+    return now.get('runtime.powerState') == 'poweredOn' and \
+        now.get('runtime.bootTime') != before.get('runtime.bootTime')
+
+
+OPERATIONS = {
+    'poweron': Operation('PowerOnVM_Task', _powered('poweredOn'), None),
+    'poweroff': Operation('PowerOffVM_Task', _powered('poweredOff'), None),
+    'suspend': Operation('SuspendVM_Task', _powered('suspended'), None),
+    'reset': Operation('ResetVM_Task', _rebooted, None),
+    'shutdown': Operation('ShutdownGuest', _powered('poweredOff'), 'poweroff'),
+    'restart': Operation('RebootGuest', _rebooted, 'reset'),
+}
+
+
+class _Watcher(object):
+    """
+    Receives the property changes of the virtual machines and tasks and
+    resolves the futures waiting for them.
+    """
+
+    def __init__(self, service_instance, vms, loop):
+        content = service_instance.content
+        self.loop = loop
+        self.state = {}
+        self.version = None
+        self._waiters = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+
+        self.collector = content.propertyCollector.CreatePropertyCollector()
+        self.view = content.viewManager.CreateListView(vms)
+        filter_spec = pchelper.build_filter_spec(self.view,
+                                                 vim.VirtualMachine, VM_PATHS)
+        filter_spec.propSet.extend(pchelper.get_property_specs(vim.Task,
+                                                               TASK_PATHS))
+        self.collector.CreateFilter(filter_spec, True)
+
+        # Initial values of every VM
+        self.poll(0)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='power-watcher')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def close(self):
+        self._stop.set()
+        # Cancel again if the thread had not started its wait yet
+        while self._thread.is_alive():
+            self.collector.CancelWaitForUpdates()
+            self._thread.join(1)
+        self.collector.DestroyPropertyCollector()
+        self.view.Destroy()
+
+    def expect(self, vm, done):
+        """
+        Returns a future resolved when done(before, now) is true for vm.
+        """
+        future = self.loop.create_future()
+        with self._lock:
+            before = dict(self.state.get(vm, {}))
+            self._waiters[vm] = (future, lambda now: done(before, now))
+        return future
+
+    def watch_task(self, task, vm):
+        """
+        Fails the future of vm if task fails.
+        """
+        with self._lock:
+            waiter = self._waiters.get(vm)
+            if waiter is None:
+                return
+            self._waiters[task] = (waiter[0], None)
+        self.view.ModifyListView(add=[task])
+
+    def forget(self, vm):
+        with self._lock:
+            self._waiters.pop(vm, None)
+
+    def poll(self, max_wait_seconds):
+        options = vmodl.query.PropertyCollector.WaitOptions()
+        options.maxWaitSeconds = max_wait_seconds
+        update = self.collector.WaitForUpdatesEx(self.version, options)
+        if update is None:
+            return
+
+        for filter_set in update.filterSet:
+            for obj_set in filter_set.objectSet:
+                state = self.state.setdefault(obj_set.obj, {})
+                for change in obj_set.changeSet:
+                    state[change.name] = change.val
+                self._check(obj_set.obj, state)
+        self.version = update.version
+
+    def _check(self, obj, state):
+        with self._lock:
+            waiter = self._waiters.get(obj)
+            if waiter is None:
+                return
+            future, done = waiter
+            if done is None:
+                # A task of the VM
+                if state.get('info.state') != vim.TaskInfo.State.error:
+                    return
+                result = state.get('info.error')
+            elif done(state):
+                result = True
+            else:
+                return
+            del self._waiters[obj]
+
+        self.loop.call_soon_threadsafe(_resolve, future, result)
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.poll(MAX_WAIT_SECONDS)
+            except vmodl.fault.RequestCanceled:
+                # CancelWaitForUpdates from close()
+                pass
+
+
+def _resolve(future, result):
+    if future.done():
+        return
+    if isinstance(result, BaseException):
+        future.set_exception(result)
+    else:
+        future.set_result(result)
+
+
+class PowerRunner(object):
+    """
+    Runs one power operation on many virtual machines.
+    """
+
+    def __init__(self, service_instance, parallel=8, timeout=300,
+                 hard_fallback=False):
+        """
+        - `parallel` (int) is the number of SOAP calls issued at once.
+        - `timeout` (int) is the number of seconds to wait for each VM.
+        - `hard_fallback` (bool) powers off (or resets) guests which did not
+          shut down (or restart) in time.
+        """
+        self.service_instance = service_instance
+        self.parallel = parallel
+        self.timeout = timeout
+        self.hard_fallback = hard_fallback
+
+    def run(self, vms, operation):
+        """
+        Returns:
+            A dict keyed by VM of (status, message), status being one of
+            'done', 'forced', 'timeout' or 'error'
+        """
+        loop = asyncio.new_event_loop()
+        executor = concurrent.futures.ThreadPoolExecutor(self.parallel)
+        watcher = _Watcher(self.service_instance, vms, loop)
+        watcher.start()
+        try:
+            results = loop.run_until_complete(
+                self._run_all(loop, executor, watcher, vms, operation))
+        finally:
+            watcher.close()
+            executor.shutdown()
+            loop.close()
+
+        return dict(zip(vms, results))
+
+    async def _run_all(self, loop, executor, watcher, vms, operation):
+        return await asyncio.gather(
+            *[self._run_one(loop, executor, watcher, vm, operation)
+              for vm in vms])
+
+    async def _call(self, loop, executor, watcher, vm, operation):
+        operation_ = OPERATIONS[operation]
+        future = watcher.expect(vm, operation_.done)
+        try:
+            result = await loop.run_in_executor(
+                executor, getattr(vm, operation_.method))
+            if isinstance(result, vim.Task):
+                await loop.run_in_executor(executor, watcher.watch_task,
+                                           result, vm)
+            await asyncio.wait_for(future, self.timeout)
+        finally:
+            watcher.forget(vm)
+
+    async def _run_one(self, loop, executor, watcher, vm, operation):
+        name = watcher.state.get(vm, {}).get('name', vm._moId)
+        try:
+            await self._call(loop, executor, watcher, vm, operation)
+            logging.info('%s: %s done', name, operation)
+            return 'done', ''
+
+        except asyncio.TimeoutError:
+            fallback = OPERATIONS[operation].fallback
+            if not self.hard_fallback or fallback is None:
+                logging.error('%s: %s timed out', name, operation)
+                return 'timeout', '{0} timed out'.format(operation)
+            logging.warning('%s: %s timed out, running %s', name, operation,
+                            fallback)
+
+        except vmodl.MethodFault as ex:
+            logging.error('%s: %s failed: %s', name, operation, ex.msg)
+            return 'error', ex.msg
+
+        try:
+            await self._call(loop, executor, watcher, vm, fallback)
+            return 'forced', '{0} timed out, {1} done'.format(operation,
+                                                              fallback)
+        except asyncio.TimeoutError:
+            return 'timeout', '{0} timed out'.format(fallback)
+        except vmodl.MethodFault as ex:
+            return 'error', ex.msg
+
+
+def run_power_operations(service_instance, vms, operation, parallel=8,
+                         timeout=300, hard_fallback=False):
+    """
+    Runs operation ('poweron', 'poweroff', 'suspend', 'reset', 'shutdown'
+    or 'restart') on vms. See PowerRunner.run.
+    """
+    runner = PowerRunner(service_instance, parallel, timeout, hard_fallback)
+    return runner.run(vms, operation)
@@ -0,0 +1,175 @@
+"""
+vMotion pre-checks, run for many virtual machines before any relocation is
+submitted.
+
+Two checks of the provisioning checker are used:
+
+- QueryVMotionCompatibilityEx, whose result only depends on the VM virtual
+  hardware and the destination host. It is run once per (hardware version,
+  destination host) pair, for all pairs of a host in one task, and cached.
+- CheckRelocate, with the actual RelocateSpec of each VM (datastore,
+  network and resource pool tests).
+
+The check tasks run in parallel through tools.tasks.TaskScheduler.
+
+Usage:
+    checker = precheck.Prechecker(SI, parallel=8)
+    results = checker.check([(vm, host, datastore), ...], pool)
+"""
+
+import collections
+import logging
+
+from pyVmomi import vim
+from pyVmomi import vmodl
+
+from tools import pchelper
+from tools import tasks
+
+RELOCATE_TESTS = ['sourceTests', 'hostTests', 'resourcePoolTests',
+                  'datastoreTests', 'networkTests']
+
+Result = collections.namedtuple('Result', ['vm', 'ok', 'errors', 'warnings'])
+
+
+def _message(fault):
+    # A failed task may have no error, and faults no message
+    if fault is None:
+        return 'Unknown fault'
+    return getattr(fault, 'msg', None) or \
+        getattr(fault, 'localizedMessage', None) or type(fault).__name__
+
+
+def _messages(faults):
+    return [_message(fault) for fault in faults or []]
+
+
+class Prechecker(object):
+    """
+    Runs the compatibility and relocate checks of planned vMotions.
+    """
+
+    def __init__(self, service_instance, parallel=8, max_wait_seconds=30):
+        """
+        - `parallel` (int) is the number of check tasks running at once.
+        """
+        self.service_instance = service_instance
+        self.parallel = parallel
+        self.max_wait_seconds = max_wait_seconds
+        # (hardware version, host) -> (errors, warnings)
+        self.cache = {}
+
+    def _run(self, calls):
+        """
+        Runs (key, function, args) check calls, parallel at most.
+
+        Returns:
+            A dict of key to the TaskInfo of its task, or to the fault raised
+            when the task could not be started
+        """
+        started = {}
+        results = {}
+        if not calls:
+            return results
+
+        def start(key, function, args):
+            try:
+                task = function(*args)
+            except vmodl.MethodFault as ex:
+                results[key] = ex
+                raise
+            started[task] = key
+            return task
+
+        scheduler = tasks.TaskScheduler(self.service_instance, self.parallel,
+                                        max_wait_seconds=self.max_wait_seconds)
+        for key, function, args in calls:
+            scheduler.submit(start, key, function, args)
+
+        for task, info in scheduler.run().items():
+            results[started[task]] = info
+        return results
+
+    def _compatibility(self, versions, moves):
+        """
+        Fills the cache for the (hardware version, host) pairs of moves, with
+        one QueryVMotionCompatibilityEx task per destination host.
+        """
+        checker = self.service_instance.content.vmProvisioningChecker
+        samples = collections.OrderedDict()
+        for vm, host, datastore in moves:
+            key = (versions.get(vm), host)
+            if host is None or key in self.cache:
+                continue
+            samples.setdefault(host, collections.OrderedDict()) \
+                .setdefault(key[0], vm)
+
+        calls = [(host, checker.QueryVMotionCompatibilityEx_Task,
+                  (list(by_version.values()), [host]))
+                 for host, by_version in samples.items()]
+        for host, info in self._run(calls).items():
+            by_version = samples[host]
+            if not isinstance(info, vim.TaskInfo) or info.state != 'success':
+                error = info if not isinstance(info, vim.TaskInfo) \
+                    else info.error
+                for version in by_version:
+                    self.cache[(version, host)] = (_messages([error]), [])
+                continue
+
+            for check in info.result or []:
+                self.cache[(versions.get(check.vm), host)] = (
+                    _messages(check.error), _messages(check.warning))
+
+    def check(self, moves, pool=None):
+        """
+        - `moves` (list) are (vm, host, datastore) tuples, None keeping the
+          current host or datastore.
+        - `pool` (vim.ResourcePool) is the destination resource pool.
+
+        Returns:
+            A dict keyed by VM of Result, in the order of moves
+        """
+        vms = [vm for vm, host, datastore in moves]
+        rows = pchelper.collect_object_properties(self.service_instance, vms,
+                                                  vim.VirtualMachine,
+                                                  ['config.version'],
+                                                  include_mors=True)
+        versions = dict((row['obj'], row.get('config.version'))
+                        for row in rows)
+
+        self._compatibility(versions, moves)
+
+        checker = self.service_instance.content.vmProvisioningChecker
+        calls = [(vm, checker.CheckRelocate_Task,
+                  (vm, vim.VirtualMachineRelocateSpec(host=host,
+                                                      datastore=datastore,
+                                                      pool=pool),
+                   RELOCATE_TESTS))
+                 for vm, host, datastore in moves]
+        relocations = self._run(calls)
+
+        results = collections.OrderedDict()
+        for vm, host, datastore in moves:
+            errors, warnings = [], []
+            if host is not None:
+                cached = self.cache.get((versions.get(vm), host), ([], []))
+                errors.extend(cached[0])
+                warnings.extend(cached[1])
+
+            info = relocations.get(vm)
+            if info is None:
+                errors.append('Relocate check did not complete')
+            elif not isinstance(info, vim.TaskInfo):
+                errors.extend(_messages([info]))
+            elif info.state != 'success':
+                errors.extend(_messages([info.error]))
+            else:
+                for check in info.result or []:
+                    errors.extend(_messages(check.error))
+                    warnings.extend(_messages(check.warning))
+
+            results[vm] = Result(vm, not errors, errors, warnings)
+            logging.debug('Precheck %s: %d error(s), %d warning(s)',
+                          vm._moId, len(errors), len(warnings))
+
+        return results
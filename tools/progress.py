@@ -0,0 +1,196 @@
+"""
+Live terminal progress of many tasks.
+
+The dashboard is fed by the progress_callback of tools.tasks.TaskMonitor
+(and TaskScheduler), which only records the new state. A separate thread
+redraws at a fixed rate from a snapshot of those states, so drawing never
+holds up the property collector update loop, however many tasks there are.
+
+Usage:
+    with progress.Dashboard(total=len(vms)) as dashboard:
+        scheduler = tasks.TaskScheduler(SI, 8,
+                                        progress_callback=dashboard.update)
+        for vm in vms:
+            scheduler.submit(dashboard.wrap(vm.RelocateVM_Task, vm.name,
+                                            size), spec=spec)
+        scheduler.run()
+"""
+
+import heapq
+import sys
+import threading
+import time
+
+GB = 1024 ** 3
+
+
+def _duration(seconds):
+    if seconds is None:
+        return '--:--:--'
+    seconds = int(seconds)
+    return '%02d:%02d:%02d' % (seconds // 3600, seconds // 60 % 60,
+                               seconds % 60)
+
+
+class _Task(object):
+    __slots__ = ('label', 'size', 'started', 'finished', 'state', 'progress')
+
+    def __init__(self, label, size, started):
+        self.label = label
+        self.size = size
+        self.started = started
+        self.finished = None
+        self.state = None
+        self.progress = 0
+
+
+class Dashboard(object):
+    """
+    Aggregated progress of a set of tasks, redrawn every interval seconds.
+    """
+
+    def __init__(self, total=None, stream=None, interval=1.0, slowest=5):
+        """
+        - `total` (int) is the number of tasks expected, for the ETA.
+          Defaults to the number of tasks seen.
+        - `stream` is where to draw, sys.stderr by default. Frames are
+          redrawn in place on a terminal, appended otherwise.
+        - `interval` (float) is the number of seconds between frames.
+        - `slowest` (int) is the number of slowest running tasks shown.
+        """
+        self.total = total
+        self.stream = stream or sys.stderr
+        self.interval = interval
+        self.slowest = slowest
+        self.started = time.time()
+
+        self._tasks = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._lines = 0
+        self._tty = hasattr(self.stream, 'isatty') and self.stream.isatty()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='dashboard')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stops the redraw thread and draws the final frame.
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.draw()
+
+    def add(self, task, label=None, size=0):
+        """
+        Registers a task.
+
+        - `label` (str) is the name shown for the task, its MoRef id by
+          default.
+        - `size` (int) is the number of bytes the task moves, for the
+          throughput.
+        """
+        with self._lock:
+            self._tasks[task] = _Task(label or task._moId, size, time.time())
+
+    def wrap(self, function, label=None, size=0):
+        """
+        Returns a function calling function and registering the task it
+        returns, to be submitted to tools.tasks.TaskScheduler.
+        """
+        def start(*args, **kwargs):
+            task = function(*args, **kwargs)
+            self.add(task, label, size)
+            return task
+        return start
+
+    def update(self, task, state):
+        """
+        progress_callback of tools.tasks.TaskMonitor: only records the state.
+        """
+        with self._lock:
+            entry = self._tasks.get(task)
+            if entry is None:
+                entry = self._tasks[task] = _Task(task._moId, 0, time.time())
+        entry.state = state.get('state')
+        entry.progress = state.get('progress') or entry.progress
+        if entry.state in ('success', 'error') and entry.finished is None:
+            entry.finished = time.time()
+
+    def _snapshot(self):
+        with self._lock:
+            return list(self._tasks.values())
+
+    def render(self, now=None):
+        """
+        Returns the lines of the current frame.
+        """
+        now = now or time.time()
+        entries = self._snapshot()
+        elapsed = max(now - self.started, 1e-6)
+
+        done = failed = 0
+        moved = 0.0
+        completed = 0.0
+        running = []
+        for entry in entries:
+            if entry.finished is not None:
+                done += 1
+                if entry.state == 'error':
+                    failed += 1
+                else:
+                    moved += entry.size
+                completed += 1
+            else:
+                fraction = entry.progress / 100.0
+                moved += entry.size * fraction
+                completed += fraction
+                running.append(entry)
+
+        total = max(self.total or 0, len(entries))
+        rate = completed / elapsed
+        eta = None
+        if rate > 0:
+            eta = (total - completed) / rate
+
+        lines = [
+            'Tasks: %d/%d done (%d failed), %d running | %.1f VMs/min | '
+            '%.1f GB migrated (%.1f MB/s) | Elapsed %s | ETA %s' % (
+                done, total, failed, len(running), done * 60.0 / elapsed,
+                moved / GB, moved / elapsed / 1024 / 1024,
+                _duration(elapsed), _duration(eta))]
+
+        for entry in heapq.nlargest(self.slowest, running,
+                                    key=lambda entry: now - entry.started):
+            lines.append('  %-40s %3d%% %s' % (entry.label[:40],
+                                              entry.progress,
+                                              _duration(now - entry.started)))
+        return lines
+
+    def draw(self):
+        lines = self.render()
+        if self._tty:
+            # Back to the first line of the previous frame and clear it
+            if self._lines:
+                self.stream.write('\x1b[%dF\x1b[J' % self._lines)
+            self.stream.write('\n'.join(lines) + '\n')
+            self._lines = len(lines)
+        else:
+            self.stream.write(lines[0] + '\n')
+        self.stream.flush()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.draw()
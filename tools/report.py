@@ -0,0 +1,409 @@
+"""
+Reporting helpers shared by the command line scripts.
+
+Results are either logged as text blocks (print_task, print_vm_info) or, with
+--output jsonl, streamed to stdout as one JSON record per line as they
+become available.
+"""
+
+import datetime
+import json
+import logging
+import sys
+import threading
+
+from pyVmomi import vim
+from pyVmomi import vmodl
+
+try:
+    import zoneinfo
+except ImportError:
+    zoneinfo = None
+
+from tools import pchelper
+
+# The summary fields print_vm_info shows, read with one property collection
+# for all virtual machines instead of the whole summary of each one.
+VM_SUMMARY_PATHS = [
+    'summary.config.name',
+    'summary.config.template',
+    'summary.config.vmPathName',
+    'summary.config.guestFullName',
+    'summary.config.instanceUuid',
+    'summary.config.uuid',
+    'summary.config.numCpu',
+    'summary.config.memorySizeMB',
+    'summary.config.annotation',
+    'summary.runtime.powerState',
+    'summary.runtime.question',
+    'summary.guest.ipAddress',
+    'summary.guest.toolsStatus',
+]
+
+
+def collect_vm_summaries(service_instance, vms, path_set=None):
+    """
+    Reads summary properties of several virtual machines in one call.
+
+    Args:
+        service_instance (ServiceInstance): ServiceInstance connection
+        vms                        (list): vim.VirtualMachine objects
+        path_set                   (list): Properties to read, defaults to
+                                           VM_SUMMARY_PATHS
+
+    Returns:
+        A list of dicts of property path to value, with the VM under 'obj',
+        in the order of vms
+    """
+    rows = pchelper.collect_object_properties(service_instance, vms,
+                                              vim.VirtualMachine,
+                                              path_set or VM_SUMMARY_PATHS,
+                                              include_mors=True)
+    by_vm = dict((row['obj'], row) for row in rows)
+    return [by_vm[vm] for vm in vms if vm in by_vm]
+
+
+def print_vm_info(summary, logger=None):
+    """
+    Logs a summary row of collect_vm_summaries (or any dict with the
+    VM_SUMMARY_PATHS keys, such as a tools.inventory row).
+    """
+    logger = logger or logging.getLogger(__name__)
+    config = 'summary.config.'
+    lines = [
+        "View virtual machime summary",
+        " Name          : " + str(summary.get(config + 'name')),
+        " Template      : " + str(summary.get(config + 'template')),
+        " Path          : " + str(summary.get(config + 'vmPathName')),
+        " Guest         : " + str(summary.get(config + 'guestFullName')),
+        " Instance UUID : " + str(summary.get(config + 'instanceUuid')),
+        " Bios UUID     : " + str(summary.get(config + 'uuid')),
+        " CPU Num       : " + str(summary.get(config + 'numCpu')),
+        " Memory Size   : " + str(summary.get(config + 'memorySizeMB')) + " MB",
+    ]
+    annotation = summary.get(config + 'annotation')
+    if annotation:
+        lines.append(" Annotation    : " + annotation)
+
+    lines.append(" State         : " + str(summary.get('summary.runtime.powerState')))
+    lines.append(" VMware-tools  : " + str(summary.get('summary.guest.toolsStatus')))
+    lines.append(" Ip address    : " + str(summary.get('summary.guest.ipAddress') or None))
+
+    question = summary.get('summary.runtime.question')
+    if question is not None:
+        lines.append(" Question      : " + question.text)
+    logger.debug("\n".join(lines))
+
+
+def vm_record(summary):
+    """
+    A summary row of collect_vm_summaries as a flat JSON record, keyed by
+    the last component of each property path.
+    """
+    record = {'type': 'vm'}
+    if 'obj' in summary:
+        record['vm'] = summary['obj']._moId
+    for path, value in summary.items():
+        if path == 'obj':
+            continue
+        if path == 'summary.runtime.question':
+            value = value.text if value is not None else None
+        record[path.rsplit('.', 1)[-1]] = value
+    return record
+
+
+def print_vm_infos(service_instance, vms, logger=None, writer=None):
+    """
+    Collects and logs the summaries of several virtual machines, or writes
+    them to writer (a JsonLinesWriter) if given.
+    """
+    for summary in collect_vm_summaries(service_instance, vms):
+        if writer is not None:
+            writer.write(vm_record(summary))
+        else:
+            print_vm_info(summary, logger)
+
+
+def task_error_type(error):
+    """
+    Short name of the fault of a failed task.
+    """
+    if isinstance(error, vim.fault.DisallowedOperationOnFailoverHost):
+        return 'DisallowedOperationOnFailoverHost'
+    elif isinstance(error, vim.fault.FileFault):
+        return 'FileFault'
+    elif isinstance(error, vim.fault.InsufficientResourcesFault):
+        return 'InsufficientResourcesFault'
+    elif isinstance(error, vmodl.fault.InvalidArgument):
+        return 'InvalidArgument'
+    elif isinstance(error, vim.fault.InvalidState):
+        if isinstance(error, vim.fault.InvalidPowerState):
+            return 'InvalidPowerState'
+        elif isinstance(error, vim.fault.InvalidDatastore):
+            return 'InvalidDatastore'
+        elif isinstance(error, vim.fault.InvalidHostState):
+            return 'InvalidHostState'
+        elif isinstance(error, vim.fault.InvalidVmState):
+            return 'InvalidVmState'
+        elif isinstance(error, vim.fault.VmPowerOnDisabled):
+            return 'VmPowerOnDisabled'
+        return 'InvalidState'
+    elif isinstance(error, vim.fault.MigrationFault):
+        return 'MigrationFault'
+    elif isinstance(error, vim.fault.Timedout):
+        return 'Timedout'
+    elif isinstance(error, vim.fault.VmConfigFault):
+        return 'VmConfigFault'
+    return str(type(error))
+
+
+_timezones = {}
+
+
+def get_timezone(name):
+    """
+    Resolves a timezone name once. zoneinfo (Python 3.9+) is used when it
+    knows the zone, pytz otherwise.
+    """
+    tz = _timezones.get(name)
+    if tz is None:
+        if zoneinfo is not None:
+            try:
+                tz = zoneinfo.ZoneInfo(name)
+            except (zoneinfo.ZoneInfoNotFoundError, ValueError):
+                tz = None
+        if tz is None:
+            # Only loaded when zoneinfo cannot resolve the zone
+            try:
+                import pytz
+            except ImportError:
+                raise ValueError("Unknown time zone {0}".format(name))
+            tz = pytz.timezone(name)
+        _timezones[name] = tz
+    return tz
+
+
+class TaskFormatter(object):
+    """
+    Formats TaskInfo reports in one timezone. The times of all the tasks
+    are converted and formatted in one pass, each distinct time once.
+    """
+
+    TIME_FORMAT = '%Y-%m-%d %H:%M:%S %Z'
+    UNSET = 'unset'
+
+    def __init__(self, timezone_name='Asia/Tokyo'):
+        self.tz = get_timezone(timezone_name)
+
+    def format_times(self, values):
+        """
+        Returns the formatted values, 'unset' for None.
+        """
+        formatted = {None: self.UNSET}
+        tz = self.tz
+        time_format = self.TIME_FORMAT
+        for value in values:
+            if value not in formatted:
+                formatted[value] = value.astimezone(tz).strftime(time_format)
+        return [formatted[value] for value in values]
+
+    def format(self, tasks):
+        """
+        Returns a list of (error, text) for tasks, error being True if the
+        task failed.
+        """
+        tasks = list(tasks)
+        times = self.format_times(
+            [value for task in tasks
+             for value in (task.queueTime, task.startTime, task.completeTime)])
+
+        reports = []
+        for index, task in enumerate(tasks):
+            queue_time, start_time, complete_time = times[3 * index:3 * index + 3]
+            difference = self.UNSET
+            if task.completeTime and task.startTime:
+                difference = str(task.completeTime - task.startTime)
+
+            lines = [
+                "View TaskInfo",
+                " Task          : " + str(task.task).strip('\''),
+                " Queue time    : " + queue_time,
+                " Start time    : " + start_time,
+                " Complete time : " + complete_time,
+                " Diff time     : " + difference + ' (complete - start)',
+                " Name          : " + str(task.entityName),
+                " Entyty        : " + str(task.entity).strip('\''),
+                " State         : " + task.state,
+                " Cancelled     : " + str(task.cancelled),
+                " Cancelable    : " + str(task.cancelable),
+            ]
+
+            error = task.error is not None
+            if error:
+                lines.append(" Error type    : " + task_error_type(task.error))
+                lines.append(" Error message : " + (getattr(task.error, 'msg', None) or ''))
+            reports.append((error, "\n".join(lines) + "\n"))
+
+        return reports
+
+    def log(self, tasks, logger=None):
+        """
+        Logs the reports of tasks, at error level for failed tasks.
+        """
+        logger = logger or logging.getLogger(__name__)
+        for error, text in self.format(tasks):
+            if error:
+                logger.error(text)
+            else:
+                logger.info(text)
+
+
+def print_task(task, timezone_name='Asia/Tokyo', logger=None):
+    """
+    Logs a TaskInfo, at error level if the task failed. Use TaskFormatter
+    for many tasks.
+    """
+    TaskFormatter(timezone_name).log([task], logger)
+
+
+def task_progress_logger(logger=None):
+    """
+    Returns a progress_callback for tools.tasks.TaskMonitor and
+    TaskScheduler logging every task change under the name of its entity:
+    failed tasks at error level, succeeded ones at info level, the others
+    at debug level.
+    """
+    logger = logger or logging.getLogger(__name__)
+
+    def log(task, state):
+        name = state.get('entityName') or task._moId
+        if state.get('state') == 'error':
+            logger.error('Entity: %s, Task: %s, State: %s', name, task._moId,
+                         state['state'])
+        elif state.get('state') == 'success':
+            logger.info('Entity: %s, Task: %s, State: %s', name, task._moId,
+                        state['state'])
+        else:
+            logger.debug('Entity: %s, Task: %s, State: %s, Progress: %s',
+                         name, task._moId, state.get('state'),
+                         state.get('progress'))
+    return log
+
+
+def report_tasks(tasks, logger=None, writer=None, timezone_name='Asia/Tokyo'):
+    """
+    Reports the tasks of a run once it is over, tasks being a dict of task
+    to TaskInfo. Without writer every report is logged. With writer only the
+    tasks still running (timed out) are written, the finished ones were
+    written by the result_callback as they completed.
+
+    Returns:
+        0 if every task succeeded, 2 otherwise
+    """
+    if writer is None:
+        TaskFormatter(timezone_name).log(tasks.values(), logger)
+
+    exit_status = 0
+    for task, info in tasks.items():
+        if writer is not None and info.state not in ('success', 'error'):
+            writer.write_task(task, info)
+        if info.state != 'success':
+            exit_status = 2
+    return exit_status
+
+
+def _isoformat(value, tz=None):
+    """
+    ISO-8601 in UTC, or in tz if given.
+    """
+    if value is None:
+        return None
+    return value.astimezone(tz or datetime.timezone.utc).isoformat()
+
+
+def task_record(task, tz=None):
+    """
+    A TaskInfo as a flat JSON record. Times are ISO-8601, in UTC unless tz
+    is given.
+    """
+    duration = None
+    if task.completeTime and task.startTime:
+        duration = (task.completeTime - task.startTime).total_seconds()
+
+    record = {
+        'type': 'task',
+        'task': task.task._moId if task.task else task.key,
+        'name': task.entityName,
+        'entity': task.entity._moId if task.entity else None,
+        'descriptionId': task.descriptionId,
+        'state': task.state,
+        'progress': task.progress,
+        'queueTime': _isoformat(task.queueTime, tz),
+        'startTime': _isoformat(task.startTime, tz),
+        'completeTime': _isoformat(task.completeTime, tz),
+        'duration': duration,
+        'cancelled': task.cancelled,
+        'cancelable': task.cancelable,
+        'errorType': None,
+        'errorMessage': None,
+    }
+    if task.error is not None:
+        record['errorType'] = task_error_type(task.error)
+        record['errorMessage'] = getattr(task.error, 'msg', None)
+    return record
+
+
+def _default(value):
+    if isinstance(value, datetime.datetime):
+        return _isoformat(value)
+    if hasattr(value, '_moId'):
+        return value._moId
+    return str(value)
+
+
+class JsonLinesWriter(object):
+    """
+    Writes records as JSON Lines, one flushed line per record, so consumers
+    can process results while the run goes on. Writers of concurrent
+    vCenters (tools.fanout) share one lock and never interleave lines.
+    """
+
+    _lock = threading.Lock()
+
+    def __init__(self, stream=None, fields=None, tz=None):
+        """
+        - `stream` is where to write, sys.stdout by default.
+        - `fields` (dict) are added to every record, e.g. the vCenter.
+        - `tz` is the timezone of the times, UTC by default.
+        """
+        self.stream = stream or sys.stdout
+        self.fields = fields or {}
+        self.tz = tz
+
+    def write(self, record):
+        if self.fields:
+            record = dict(self.fields, **record)
+        line = json.dumps(record, default=_default, sort_keys=True)
+        with self._lock:
+            self.stream.write(line + '\n')
+            self.stream.flush()
+
+    def write_task(self, task, info=None):
+        """
+        Writes a TaskInfo, usable as tools.tasks.TaskScheduler
+        result_callback.
+        """
+        self.write(task_record(info if info is not None else task, self.tz))
+
+
+def writer_from_args(args):
+    """
+    The JsonLinesWriter requested on the command line (--output jsonl), or
+    None for text output.
+    """
+    if getattr(args, 'output', 'text') != 'jsonl':
+        return None
+    tz = None
+    if getattr(args, 'output_localtime', False):
+        tz = get_timezone(args.timezone)
+    return JsonLinesWriter(fields={'vcenter': args.host}, tz=tz)
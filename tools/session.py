@@ -0,0 +1,143 @@
+"""
+Connection factory for the command line scripts.
+
+With --session-cache the vmware_soap_session cookie of a login is kept in a
+file readable only by the current user. The next invocation validates it
+with SessionManager.currentSession and only logs in again when the session
+has expired on the vCenter side or the cached copy is too old. Cached
+sessions are not logged out at exit, so they can be reused.
+"""
+
+import atexit
+import hashlib
+import json
+import logging
+import os
+import ssl
+import time
+
+from pyVim import connect
+from pyVmomi import SoapStubAdapter
+from pyVmomi import vim
+from pyVmomi import vmodl
+
+from tools import cli
+
+DEFAULT_DIR = os.path.join(os.path.expanduser('~'), '.cache',
+                           'vmware-pyvmomi-tools', 'sessions')
+DEFAULT_EXPIRY = 1800
+
+
+def _cache_path(args, directory=DEFAULT_DIR):
+    key = '{0}:{1}:{2}'.format(args.host, args.port, args.user)
+    return os.path.join(directory,
+                        hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+
+def _ssl_context(args):
+    if args.disable_ssl_verification:
+        return ssl._create_unverified_context()
+    return None
+
+
+def _load(path, expiry):
+    try:
+        with open(path) as cache_file:
+            cached = json.load(cache_file)
+    except (IOError, OSError, ValueError):
+        return None
+
+    if time.time() - cached.get('saved', 0) > expiry:
+        return None
+    return cached
+
+
+def _save(path, service_instance):
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory, 0o700)
+
+    stub = service_instance._stub
+    cached = {
+        'cookie': stub.cookie,
+        'version': stub.version,
+        'saved': time.time(),
+    }
+    # Create the file with owner only permissions before writing the cookie.
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    os.fchmod(fd, 0o600)
+    with os.fdopen(fd, 'w') as cache_file:
+        json.dump(cached, cache_file)
+
+
+def _discard(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def _resume(args, cached):
+    """
+    Rebuilds a ServiceInstance on a cached session cookie.
+
+    Returns:
+        The ServiceInstance, or None if the session is no longer valid
+    """
+    stub = SoapStubAdapter(host=args.host,
+                           port=int(args.port),
+                           version=cached['version'],
+                           sslContext=_ssl_context(args))
+    stub.cookie = cached['cookie']
+    service_instance = vim.ServiceInstance('ServiceInstance', stub)
+    try:
+        if service_instance.content.sessionManager.currentSession:
+            return service_instance
+    except vmodl.MethodFault as ex:
+        logging.debug('Cached session rejected: %s', ex.msg)
+
+    return None
+
+
+def login(args):
+    """
+    Logs in with user and password, prompting for the password if needed.
+    """
+    prompt = getattr(args, 'password_prompt', None) or \
+        cli.prompt_for_password
+    prompt(args)
+    # SmartConnectNoSSL is gone from recent pyVmomi, pass the context
+    return connect.SmartConnect(host=args.host,
+                                user=args.user,
+                                pwd=args.password,
+                                port=int(args.port),
+                                sslContext=_ssl_context(args))
+
+
+def connect_from_args(args):
+    """
+    Returns a ServiceInstance for the connection described by the standard
+    arguments of tools.cli.build_arg_parser, reusing a cached session when
+    --session-cache is set.
+
+    Without the cache the session is logged out at exit, as before.
+    """
+    if not getattr(args, 'session_cache', False):
+        service_instance = login(args)
+        if service_instance:
+            atexit.register(connect.Disconnect, service_instance)
+        return service_instance
+
+    path = _cache_path(args)
+    cached = _load(path, args.session_expiry)
+    if cached:
+        service_instance = _resume(args, cached)
+        if service_instance:
+            logging.debug('Reusing cached session for %s', args.host)
+            return service_instance
+        _discard(path)
+
+    service_instance = login(args)
+    if service_instance:
+        _save(path, service_instance)
+    return service_instance
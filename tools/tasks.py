@@ -3,58 +3,332 @@ Written by Michael Rice <michael@michaelrice.org>
 
 Github: https://github.com/michaelrice
 Website: https://michaelrice.github.io/
-Blog: http://www.errr-online.com/
 This code has been released under the terms of the Apache 2 licenses
 http://www.apache.org/licenses/LICENSE-2.0.html
 
 Helper module for task operations.
 """
+import logging
+import time
+
 from pyVmomi import vim
 from pyVmomi import vmodl
 
+from tools import pchelper
+
+# Only the properties needed to follow a task, the full TaskInfo is read once
+# per task when it is done.
+TASK_PATHS = ['info.state', 'info.progress', 'info.error',
+              'info.completeTime', 'info.entityName']
+
+FINISHED_STATES = (vim.TaskInfo.State.success, vim.TaskInfo.State.error)
+
+
+class TaskMonitor(object):
+    """
+    Follows any number of tasks through a single property filter.
+
+    Tasks are kept in a ListView the filter traverses, so tasks can be added
+    while others are running and finished tasks are dropped from the view.
+    """
+
+    def __init__(self, service_instance, progress_callback=None):
+        """
+        - `service_instance` is the ServiceInstance connection.
+        - `progress_callback` (callable) is called with the task and its
+          state dict ('state', 'progress', 'error', 'completeTime',
+          'entityName') every
+          time the task changes.
+        """
+        content = service_instance.content
+        # A private collector, so updates of other filters on the session
+        # (and of other monitors) are never consumed here.
+        self.property_collector = \
+            content.propertyCollector.CreatePropertyCollector()
+        self.progress_callback = progress_callback
+        self.version = None
+        self.pending = {}
+        self.finished = {}
+
+        self._view = content.viewManager.CreateListView([])
+        filter_spec = pchelper.build_filter_spec(self._view, vim.Task,
+                                                 TASK_PATHS)
+        self._filter = self.property_collector.CreateFilter(filter_spec, True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """
+        Destroys the property collector, its filter and the view.
+        """
+        if self._filter is not None:
+            self._filter = None
+            self.property_collector.DestroyPropertyCollector()
+        if self._view is not None:
+            self._view.Destroy()
+            self._view = None
+
+    def add(self, tasks):
+        """
+        Starts following tasks.
+        """
+        tasks = [task for task in tasks
+                 if task not in self.pending and task not in self.finished]
+        if not tasks:
+            return
+        for task in tasks:
+            self.pending[task] = {}
+        self._view.ModifyListView(add=tasks)
+
+    def poll(self, max_wait_seconds=30):
+        """
+        Waits up to max_wait_seconds for task updates.
+
+        Returns:
+            The list of tasks which finished during this call
+        """
+        options = vmodl.query.PropertyCollector.WaitOptions()
+        options.maxWaitSeconds = max_wait_seconds
+        update = self.property_collector.WaitForUpdatesEx(self.version,
+                                                          options)
+        if update is None:
+            return []
+
+        done = []
+        for filter_set in update.filterSet:
+            for obj_set in filter_set.objectSet:
+                task = obj_set.obj
+                state = self.pending.get(task)
+                if state is None:
+                    continue
+
+                for change in obj_set.changeSet:
+                    # 'info.state' -> 'state'
+                    state[change.name[5:]] = change.val
+
+                if self.progress_callback is not None:
+                    self.progress_callback(task, state)
+
+                if state.get('state') in FINISHED_STATES:
+                    self.finished[task] = self.pending.pop(task)
+                    done.append(task)
+
+        self.version = update.version
+        if done:
+            self._view.ModifyListView(remove=done)
+
+        return done
+
+
+def collect_task_info(service_instance, tasks):
+    """
+    Reads the full TaskInfo of several tasks in one call.
+
+    Returns:
+        A dict of TaskInfo keyed by task
+    """
+    rows = pchelper.collect_object_properties(service_instance, tasks,
+                                              vim.Task, ['info'],
+                                              include_mors=True)
+    found = dict((row['obj'], row['info']) for row in rows if 'info' in row)
+
+    # Keep the order the tasks were given in
+    infos = {}
+    for task in tasks:
+        if task in found:
+            infos[task] = found[task]
+    return infos
+
+
+def _task_error(task, state):
+    """
+    The fault of a failed task. The update reporting the error state may
+    come without info.error, which is then read from the task.
+    """
+    error = state.get('error')
+    if error is None:
+        error = task.info.error
+    if error is None:
+        error = vmodl.MethodFault(
+            msg='Task {0} ended in state {1}'.format(task._moId,
+                                                     state.get('state')))
+    return error
 
-def wait_for_tasks(service_instance, tasks):
+
+def wait_for_tasks(service_instance, tasks, timeout=None, max_wait_seconds=30,
+                   progress_callback=None, raise_on_error=True):
     """Given the service instance si and tasks, it returns after all the
-   tasks are complete
+   tasks are complete, or after timeout seconds.
+
+   Returns a dict of the final TaskInfo keyed by task. Tasks still running
+   when the timeout expires are included with their current TaskInfo.
+   If raise_on_error is set, the error of the first failed task is raised
+   instead.
    """
-    property_collector = service_instance.content.propertyCollector
-    task_list = [str(task) for task in tasks]
-    # Create filter
-    obj_specs = [vmodl.query.PropertyCollector.ObjectSpec(obj=task)
-                 for task in tasks]
-    property_spec = vmodl.query.PropertyCollector.PropertySpec(type=vim.Task,
-                                                               pathSet=[],
-                                                               all=True)
-    filter_spec = vmodl.query.PropertyCollector.FilterSpec()
-    filter_spec.objectSet = obj_specs
-    filter_spec.propSet = [property_spec]
-    pcfilter = property_collector.CreateFilter(filter_spec, True)
-    try:
-        version, state = None, None
-        # Loop looking for updates till the state moves to a completed state.
-        while len(task_list):
-            update = property_collector.WaitForUpdates(version)
-            for filter_set in update.filterSet:
-                for obj_set in filter_set.objectSet:
-                    task = obj_set.obj
-                    for change in obj_set.changeSet:
-                        if change.name == 'info':
-                            state = change.val.state
-                        elif change.name == 'info.state':
-                            state = change.val
-                        else:
-                            continue
-
-                        if not str(task) in task_list:
-                            continue
-
-                        if state == vim.TaskInfo.State.success:
-                            # Remove task from taskList
-                            task_list.remove(str(task))
-                        elif state == vim.TaskInfo.State.error:
-                            raise task.info.error
-            # Move to next version
-            version = update.version
-    finally:
-        if pcfilter:
-            pcfilter.Destroy()
+    if not tasks:
+        return {}
+
+    deadline = None
+    if timeout is not None:
+        deadline = time.time() + timeout
+
+    with TaskMonitor(service_instance, progress_callback) as monitor:
+        monitor.add(tasks)
+        while monitor.pending:
+            wait = max_wait_seconds
+            if deadline is not None:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    logging.warning('%d task(s) still running after %s '
+                                    'seconds', len(monitor.pending), timeout)
+                    break
+                wait = int(min(wait, max(remaining, 1)))
+
+            for task in monitor.poll(wait):
+                if raise_on_error and \
+                        monitor.finished[task].get('state') == \
+                        vim.TaskInfo.State.error:
+                    raise _task_error(task, monitor.finished[task])
+
+    return collect_task_info(service_instance, tasks)
+
+
+class TaskScheduler(object):
+    """
+    Submits queued operations while keeping the number of running tasks
+    under a global limit and under per-resource limits (e.g. per host,
+    datastore or cluster). The next operation is started as soon as a task
+    finishes, as reported by the property collector.
+
+    Usage:
+        scheduler = TaskScheduler(SI, max_in_flight=8, limits={'host': 2})
+        for vm in vms:
+            scheduler.submit(vm.PowerOnVM_Task, keys={'host': hosts[vm]})
+        results = scheduler.run()
+    """
+
+    def __init__(self, service_instance, max_in_flight=None, limits=None,
+                 progress_callback=None, max_wait_seconds=30,
+                 result_callback=None):
+        """
+        - `max_in_flight` (int) is the global number of running tasks.
+          None means no limit.
+        - `limits` (dict) maps a resource kind ('host', 'datastore',
+          'cluster', ...) to the number of running tasks allowed per
+          resource of that kind.
+        - `result_callback` (callable) is called with each task and its
+          final TaskInfo as soon as it is done. The TaskInfo of the tasks
+          finishing together are read in one call.
+        """
+        self.service_instance = service_instance
+        self.max_in_flight = max_in_flight or None
+        self.limits = dict((kind, limit) for kind, limit in
+                           (limits or {}).items() if limit)
+        self.progress_callback = progress_callback
+        self.max_wait_seconds = max_wait_seconds
+        self.result_callback = result_callback
+
+        self.queue = []
+        self.tasks = []
+        self.failed = []
+        self._in_flight = {}
+        self._usage = {}
+
+    def submit(self, function, *args, keys=None, **kwargs):
+        """
+        Queues function(*args, **kwargs), which must return a vim.Task.
+
+        - `keys` (dict, keyword only) maps a resource kind to the resource (or list of
+          resources) the task will use.
+        """
+        usage = []
+        for kind, resources in (keys or {}).items():
+            if kind not in self.limits or resources is None:
+                continue
+            if not isinstance(resources, (list, tuple)):
+                resources = [resources]
+            usage.extend((kind, resource) for resource in resources
+                         if resource is not None)
+
+        self.queue.append((function, args, kwargs, usage))
+
+    def _allowed(self, usage):
+        for key in usage:
+            if self._usage.get(key, 0) >= self.limits[key[0]]:
+                return False
+        return True
+
+    def _start_ready(self, monitor):
+        started = []
+        waiting = []
+        for item in self.queue:
+            function, args, kwargs, usage = item
+            if (self.max_in_flight is not None and
+                    len(self._in_flight) >= self.max_in_flight) \
+                    or not self._allowed(usage):
+                waiting.append(item)
+                continue
+
+            try:
+                task = function(*args, **kwargs)
+            except vmodl.MethodFault as ex:
+                logging.error('Task submission failed: %s', ex.msg)
+                self.failed.append((function, ex))
+                continue
+
+            for key in usage:
+                self._usage[key] = self._usage.get(key, 0) + 1
+            self._in_flight[task] = usage
+            self.tasks.append(task)
+            started.append(task)
+
+        self.queue = waiting
+        monitor.add(started)
+
+    def _release(self, task):
+        for key in self._in_flight.pop(task, ()):
+            self._usage[key] -= 1
+
+    def run(self, timeout=None):
+        """
+        Runs every queued operation.
+
+        Returns:
+            A dict of the final TaskInfo keyed by task, in submission order.
+            Operations which could not be submitted are in self.failed.
+        """
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+
+        with TaskMonitor(self.service_instance,
+                         self.progress_callback) as monitor:
+            self._start_ready(monitor)
+            while self._in_flight:
+                wait = self.max_wait_seconds
+                if deadline is not None:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        logging.warning('%d task(s) still running and %d '
+                                        'not started after %s seconds',
+                                        len(self._in_flight),
+                                        len(self.queue), timeout)
+                        break
+                    wait = int(min(wait, max(remaining, 1)))
+
+                done = monitor.poll(wait)
+                for task in done:
+                    self._release(task)
+                if done:
+                    self._start_ready(monitor)
+                if done and self.result_callback is not None:
+                    infos = collect_task_info(self.service_instance, done)
+                    for task in done:
+                        if task in infos:
+                            self.result_callback(task, infos[task])
+
+        return collect_task_info(self.service_instance, self.tasks)
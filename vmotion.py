@@ -5,35 +5,33 @@
 Copyright (c) 2017 h-mineta <h-mineta@0nyx.net>
 This software is released under the MIT License.
 
-pip3 install pyvmomi pytz
+pip3 install pyvmomi
+pip3 install pytz (Python 3.8 and older only)
 """
 
-import atexit
 import sys
-import re
-from datetime import datetime
 from logging import getLogger, Formatter, StreamHandler, CRITICAL, WARNING, INFO, DEBUG
 logger = getLogger(__name__)
 
-from pyVim import connect
-from pyVmomi import vmodl
 from pyVmomi import vim
-import pytz
 
-from tools import cli, get
+from tools import cli, fanout, get, index, placement, precheck, progress, report, tasks
+
+# 計画/退避モードで--max-tasks*の指定がない場合の同時実行数
+PLANNED_MAX_TASKS = 8
 
 def setup_args():
     parser = cli.build_arg_parser()
 
     parser.add_argument('-V', '--vmhosts',
-                        required=True,
+                        required=False,
                         action='append',
                         help='VMhost names')
 
     parser.add_argument('-P', '--destination-pool',
                         required=False,
                         default=None,
-                        help='Destination resource pool name')
+                        help='Destination resource pool MoRef (resgroup-N), or path under the --cluster root pool')
 
     parser.add_argument('-H', '--destination-esxi',
                         required=False,
@@ -45,178 +43,274 @@ def setup_args():
                         default=None,
                         help='Destination datastore name')
 
-    parser.add_argument('--verbose',
-                        action='store_true',
-                        default=False,
-                        help='Verbose mode(default: False)',)
-
-    parser.add_argument('--timezone',
+    parser.add_argument('--candidate-esxi',
                         required=False,
-                        default='Asia/Tokyo',
-                        help='Default time zone (Asia/Tokyo)')
-
-    return cli.prompt_for_password(parser.parse_args())
+                        action='append',
+                        help='Candidate destination ESXi hostname, may be repeated (balanced planning, at most %d tasks at once unless --max-tasks* is given)' % PLANNED_MAX_TASKS)
 
-def print_task(task, timezone_name='Asia/Tokyo'):
-    error_type = None
-    message = ''
+    parser.add_argument('--candidate-datastore',
+                        required=False,
+                        action='append',
+                        help='Candidate destination datastore name, may be repeated (balanced planning)')
 
-    if task.error != None:
-        error = task.error
-        if isinstance(error, vmodl.fault.InvalidArgument):
-            error_type = 'InvalidArgument'
+    parser.add_argument('--evacuate-esxi',
+                        required=False,
+                        default=None,
+                        help='Move every VM off this ESXi host, to the other hosts of its cluster by default (at most %d tasks at once unless --max-tasks* is given)' % PLANNED_MAX_TASKS)
 
-        elif isinstance(error, vmodl.RuntimeFault):
-            error_type = 'RuntimeFault'
+    parser.add_argument('--max-host-usage',
+                        required=False,
+                        type=int,
+                        default=90,
+                        help='Maximum planned CPU and memory usage of a host in percent (default: 90)')
 
-        if isinstance(error, vim.fault.DisallowedOperationOnFailoverHost):
-            error_type = 'DisallowedOperationOnFailoverHost'
+    parser.add_argument('--max-datastore-usage',
+                        required=False,
+                        type=int,
+                        default=90,
+                        help='Maximum planned used space of a datastore in percent (default: 90)')
 
-        elif isinstance(error, vim.fault.FileFault):
-            error_type = 'FileFault'
+    parser.add_argument('--dry-run',
+                        action='store_true',
+                        default=False,
+                        help='Only show the planned moves (and the precheck results)')
 
-        elif isinstance(error, vim.fault.InsufficientResourcesFault):
-            error_type = 'InsufficientResourcesFault'
+    parser.add_argument('--precheck',
+                        action='store_true',
+                        default=False,
+                        help='Run the vMotion compatibility and relocate checks first, only move the VMs which pass')
 
-        elif isinstance(error, vmodl.fault.InvalidArgument):
-            error_type = 'InvalidArgument'
+    parser.add_argument('--precheck-parallel',
+                        required=False,
+                        type=int,
+                        default=8,
+                        help='Number of check tasks running at the same time (default: 8)')
 
-        elif isinstance(error, vim.fault.InvalidState):
-            if isinstance(error, vim.fault.InvalidPowerState):
-                error_type = 'InvalidPowerState'
-            elif isinstance(error, vim.fault.InvalidDatastore):
-                error_type = 'InvalidDatastore'
-            elif isinstance(error, vim.fault.InvalidHostState):
-                error_type = 'InvalidHostState'
-            elif isinstance(error, vim.fault.InvalidVmState):
-                error_type = 'InvalidVmState'
-            elif isinstance(error, vim.fault.VmPowerOnDisabled):
-                error_type = 'VmPowerOnDisabled'
-            else:
-                error_type = 'InvalidState'
+    parser.add_argument('--progress',
+                        action='store_true',
+                        default=False,
+                        help='Show a live progress view of the tasks on the terminal')
 
-        elif isinstance(error, vim.fault.MigrationFault):
-            error_type = 'MigrationFault'
+    parser.add_argument('--verbose',
+                        action='store_true',
+                        default=False,
+                        help='Verbose mode(default: False)',)
 
-        elif isinstance(error, vim.fault.Timedout):
-            error_type = 'Timedout'
+    parser.add_argument('--task-timeout',
+                        required=False,
+                        type=int,
+                        default=None,
+                        help='Seconds to wait for tasks to complete (default: no limit)')
 
-        elif isinstance(error, vim.fault.VmConfigFault):
-            error_type = 'VmConfigFault'
+    parser.add_argument('--timezone',
+                        required=False,
+                        default='Asia/Tokyo',
+                        help='Default time zone (Asia/Tokyo)')
 
+    cli.add_task_limit_arguments(parser)
+
+    cli.add_vm_selector_arguments(parser)
+
+    args = parser.parse_args()
+    if not args.vmhosts and not cli.has_vm_selector(args) and not args.evacuate_esxi:
+        parser.error('one of the arguments -V/--vmhosts --vm-uuid --vm-ip --vm-path --evacuate-esxi is required')
+
+    return args
+
+def plan_moves(service_instance, content, args, vm_list, evacuate_host, name_index, scope):
+    # 候補ホスト/データストアへ負荷を均等に配置
+    hosts = []
+    if args.candidate_esxi:
+        hosts = get.get_hosts_by_names(content, args.candidate_esxi, name_index, scope[vim.HostSystem])
+        if len(hosts) == 0:
+            logger.warning('ESXi host is not found')
+            return None
+    elif evacuate_host is not None:
+        if args.cluster:
+            hosts = get.get_hosts(content, scope[vim.HostSystem])
+        elif isinstance(evacuate_host.parent, vim.ClusterComputeResource):
+            hosts = list(evacuate_host.parent.host)
         else:
-            error_type = str(type(error))
-
-        # error message
-        if hasattr(error, 'msg'):
-            message = error.msg
-
-    tz = pytz.timezone(timezone_name)
-    time_to_queue = tz.normalize(task.queueTime.astimezone(tz))
-    time_to_start = tz.normalize(task.startTime.astimezone(tz))
-    time_to_complite = "unset"
-    time_to_difference = "unset"
-    if task.completeTime:
-        time_to_complite = tz.normalize(task.completeTime.astimezone(tz))
-        time_to_difference = task.completeTime - task.startTime
-
-    output = "View TaskInfo" \
-        + "\n Task          : " + str(task.task).strip('\'') \
-        + "\n Queue time    : " + time_to_queue.strftime('%Y-%m-%d %H:%M:%S %Z') \
-        + "\n Start time    : " + time_to_start.strftime('%Y-%m-%d %H:%M:%S %Z') \
-        + "\n Complete time : " + time_to_complite.strftime('%Y-%m-%d %H:%M:%S %Z') \
-        + "\n Diff time     : " + str(time_to_difference) + ' (complete - start)' \
-        + "\n Name          : " + task.entityName \
-        + "\n Entyty        : " + str(task.entity).strip('\'') \
-        + "\n State         : " + task.state \
-        + "\n Cancelled     : " + str(task.cancelled) \
-        + "\n Cancelable    : " + str(task.cancelable)
-
-    if error_type:
-        output = output \
-            + "\n Error type    : " + error_type \
-            + "\n Error message : " + message
-        logger.error(output + "\n")
+            logger.warning('ESXi host is not in a cluster, give --candidate-esxi')
+            return None
+    if evacuate_host is not None:
+        hosts = [host for host in hosts if host != evacuate_host]
+        if len(hosts) == 0:
+            logger.error('No candidate ESXi host is left to evacuate %s to' % (args.evacuate_esxi))
+            return None
+
+    datastores = []
+    if args.candidate_datastore:
+        datastores = get.get_datastores_by_names(content, args.candidate_datastore, name_index, scope[vim.Datastore])
+        if len(datastores) == 0:
+            logger.warning('Datastore is not found')
+            return None
+
+    planner = placement.Planner(service_instance, hosts, datastores,
+                                args.max_host_usage / 100.0,
+                                args.max_datastore_usage / 100.0)
+    moves, unplaced = planner.plan(vm_list)
+
+    for move in moves:
+        logger.info("Plan: %s -> ESXi: %s, Datastore: %s" % (move.name, planner.names.get(move.host, '(unchanged)'), planner.names.get(move.datastore, '(unchanged)')))
+    for vm in unplaced:
+        logger.warning("Plan: %s does not fit on any candidate" % (planner.names.get(vm, vm._moId)))
+
+    moves = [move for move in moves if move.host or move.datastore]
+    if evacuate_host is not None and unplaced:
+        logger.error('%d virtual machines cannot be evacuated' % (len(unplaced)))
+        return None
+
+    return moves
+
+def precheck_moves(service_instance, args, moves, pool):
+    # vMotion互換性/Relocateチェック(並列)
+    checker = precheck.Prechecker(service_instance, args.precheck_parallel)
+    results = checker.check([(move.vm, move.host, move.datastore) for move in moves], pool)
+
+    passed = []
+    for move in moves:
+        result = results[move.vm]
+        name = move.name or move.vm._moId
+        for warning in result.warnings:
+            logger.warning("Precheck: %s, Warning: %s" % (name, warning))
+        for error in result.errors:
+            logger.error("Precheck: %s, Error: %s" % (name, error))
+        if result.ok:
+            passed.append(move)
+
+    logger.info("Precheck: %d/%d virtual machines passed" % (len(passed), len(moves)))
+    return passed
+
+def run(service_instance, args):
+    exit_status = 0
 
+    content = service_instance.RetrieveContent()
+    name_index = index.from_args(args)
+    writer = report.writer_from_args(args)
+    scope = get.get_scope_from_args(content, args)
+    if scope is None:
+        logger.warning('Datacenter, cluster or folder is not found')
+        return 1
+
+    # VM List作成
+    vm_list = get.get_vms_by_selectors(content, args.vmhosts, args.vm_uuid, args.vm_ip, args.vm_path, name_index, scope)
+
+    evacuate_host = None
+    if args.evacuate_esxi:
+        evacuate_host = get.get_host_by_name(content, args.evacuate_esxi, name_index, scope[vim.HostSystem])
+        if evacuate_host is None:
+            return fanout.not_found(logger, 'ESXi host is not found')
+        vm_list.extend(vm for vm in evacuate_host.vm if vm not in vm_list)
+
+    if len(vm_list) == 0:
+        return fanout.not_found(logger, 'Virtual Machine is not found')
+
+    # Relocate(vMotion)のためのSpecデータ作成
+    relocate_spec = vim.VirtualMachineRelocateSpec()
+    if args.destination_esxi:
+        relocate_spec.host  = get.get_host_by_name(content, args.destination_esxi, name_index, scope[vim.HostSystem])
+        if relocate_spec.host is None:
+            logger.warning('ESXi host is not found')
+            return 1
+
+    if args.destination_datastore:
+        relocate_spec.datastore = get.get_datastore_by_name(content, args.destination_datastore, name_index, scope[vim.Datastore])
+        if relocate_spec.datastore is None:
+            logger.warning('Datastore is not found')
+            return 1
+
+    if args.destination_pool:
+        relocate_spec.pool = get.get_pool(content, args.destination_pool, scope[vim.ResourcePool])
+        if relocate_spec.pool is None:
+            logger.warning('Pool is not found')
+            return 1
+
+    moves = [placement.Move(vm, None, relocate_spec.host, relocate_spec.datastore) for vm in vm_list]
+    if args.candidate_esxi or args.candidate_datastore or evacuate_host:
+        moves = plan_moves(service_instance, content, args, vm_list, evacuate_host, name_index, scope)
+        if moves is None:
+            return 1
+
+    if args.precheck:
+        passed = precheck_moves(service_instance, args, moves, relocate_spec.pool)
+        if len(passed) != len(moves):
+            exit_status = 2
+        moves = passed
+
+    if args.dry_run:
+        return exit_status
+
+    if len(moves) == 0:
+        logger.info('No virtual machine to move')
+        return exit_status
+
+    max_tasks = args.max_tasks
+    planned = args.candidate_esxi or args.candidate_datastore or evacuate_host
+    if planned and max_tasks is None and not any(cli.get_task_limits(args).values()):
+        max_tasks = PLANNED_MAX_TASKS
+
+    dashboard = None
+    progress_callback = report.task_progress_logger(logger)
+    sizes = {}
+    if args.progress:
+        # 移行量: Storage vMotionはディスク、それ以外はメモリ
+        dashboard = progress.Dashboard(total=len(moves))
+        progress_callback = dashboard.update
+        for row in report.collect_vm_summaries(service_instance, [move.vm for move in moves], ['name', 'summary.storage.committed', 'config.hardware.memoryMB']):
+            sizes[row['obj']] = row
+
+    scheduler = tasks.TaskScheduler(service_instance, max_tasks,
+                                    cli.get_task_limits(args),
+                                    progress_callback=progress_callback,
+                                    result_callback=writer.write_task if writer is not None else None)
+    placements = {}
+    if any(cli.get_task_limits(args).values()):
+        placements = get.get_vm_placements(content, vm_list)
+
+    for move in moves:
+        spec = relocate_spec
+        if move.host != relocate_spec.host or move.datastore != relocate_spec.datastore:
+            spec = vim.VirtualMachineRelocateSpec(pool=relocate_spec.pool, host=move.host, datastore=move.datastore)
+
+        # vMotion uses both the source and the destination host (once when
+        # the VM stays on its host)
+        vm_placement = placements.get(move.vm, {})
+        keys = {
+            'host': list(set([vm_placement.get('host'), spec.host]) - set([None])),
+            'datastore': [spec.datastore] if spec.datastore else vm_placement.get('datastore'),
+            'cluster': vm_placement.get('cluster'),
+        }
+        function = move.vm.RelocateVM_Task
+        if dashboard is not None:
+            row = sizes.get(move.vm, {})
+            if spec.datastore:
+                size = row.get('summary.storage.committed') or 0
+            else:
+                size = (row.get('config.hardware.memoryMB') or 0) * 1024 * 1024
+            function = dashboard.wrap(function, row.get('name'), size)
+        scheduler.submit(function, keys=keys,
+                         spec=spec, priority='defaultPriority')
+
+    if dashboard is not None:
+        with dashboard:
+            finish_tasks = scheduler.run(timeout=args.task_timeout)
     else:
-        logger.info(output + "\n")
-
-def wait_for_tasks(service_instance, tasks):
-    finish_tasks = {}
-
-    if not len(tasks):
-        return finish_tasks
-
-    property_collector = service_instance.content.propertyCollector
-    task_list = [str(task) for task in tasks]
-    # Create filter
-    obj_specs = [vmodl.query.PropertyCollector.ObjectSpec(obj=task)
-                 for task in tasks]
-    property_spec = vmodl.query.PropertyCollector.PropertySpec(type=vim.Task,
-                                                               pathSet=[],
-                                                               all=True)
-    filter_spec = vmodl.query.PropertyCollector.FilterSpec()
-    filter_spec.objectSet = obj_specs
-    filter_spec.propSet = [property_spec]
-    pcfilter = property_collector.CreateFilter(filter_spec, True)
-    atexit.register(pcfilter.Destroy)
-
-    try:
-        version = None
-        # Loop looking for updates till the state moves to a completed state.
-        while len(task_list):
-            update = property_collector.WaitForUpdates(version)
-            for filter_set in update.filterSet:
-                for obj_set in filter_set.objectSet:
-                    task = obj_set.obj
-                    task_name = str(task)
-                    if not task_name in task_list:
-                        continue
-
-                    for change in obj_set.changeSet:
-                        # Append finish task values
-                        if isinstance(change.val, vim.TaskInfo):
-                            # set
-                            finish_tasks[task_name] = change.val
-                            logger.info("Name: %s, State: %s" % (finish_tasks[task_name].entityName, finish_tasks[task_name].state))
-
-                        elif task_name in finish_tasks:
-                            matchese = re.match(r'^info\.(.+)$', change.name)
-                            if matchese:
-                                # modify(Update)
-                                key = matchese.group(1)
-                                setattr(finish_tasks[task_name], key, change.val)
-                                if key == 'progress' and isinstance(change.val, int) == True:
-                                    logger.debug("Name: %s, Progress: %d" % (finish_tasks[task_name].entityName, change.val))
-                                elif key == 'state':
-                                    if change.val == 'error':
-                                        logger.error("Name: %s, State: %s" % (finish_tasks[task_name].entityName, change.val))
-                                    else:
-                                        logger.info("Name: %s, State: %s" % (finish_tasks[task_name].entityName, change.val))
-
-                    if task_name in finish_tasks \
-                    and (finish_tasks[task_name].state == 'success' or finish_tasks[task_name].state == 'error') \
-                    and finish_tasks[task_name].completeTime != None:
-                        # Remove task from taskList
-                        task_list.remove(task_name)
-
-            # Move to next version
-            version = update.version
-
-    except vmodl.RuntimeFault as ex:
-        logger.error('Caught RuntimeFault fault : ' + ex.msg)
-
-    except vmodl.MethodFault as ex:
-        logger.error('Caught MethodFault fault : ' + ex.msg)
-
-    except Exception as ex:
-        raise
-
-    return finish_tasks
+        finish_tasks = scheduler.run(timeout=args.task_timeout)
+    if len(scheduler.failed):
+        exit_status = 2
+
+    if len(finish_tasks) == 0:
+        logger.error('Finish task is not found')
+        return 2
+
+    if report.report_tasks(finish_tasks, logger, writer, args.timezone):
+        exit_status = 2
+
+    return exit_status
 
 def main():
     args = setup_args()
-    exit_status = 0
 
     # logger setting
     formatter = Formatter('[%(asctime)s]%(levelname)s - %(message)s')
@@ -231,89 +325,12 @@ def main():
     console.setFormatter(formatter)
     logger.addHandler(console)
 
-    if not args.destination_esxi and not args.destination_datastore:
+    if not args.destination_esxi and not args.destination_datastore \
+            and not args.candidate_esxi and not args.candidate_datastore and not args.evacuate_esxi:
         logger.critical("Could not destination esxi or datastore")
         sys.exit(1)
 
-    try:
-        if args.disable_ssl_verification:
-            service_instance = connect.SmartConnectNoSSL(host=args.host,
-                                                         user=args.user,
-                                                         pwd=args.password,
-                                                         port=int(args.port))
-        else:
-            service_instance = connect.SmartConnect(host=args.host,
-                                                    user=args.user,
-                                                    pwd=args.password,
-                                                    port=int(args.port))
-
-        if not service_instance:
-            logger.critical("Could not connect to the specified host ' \
-                            'using specified username and password")
-            sys.exit(1)
-
-        atexit.register(connect.Disconnect, service_instance)
-
-        content = service_instance.RetrieveContent()
-
-        # VM List作成
-        vm_list = get.get_vms_by_names(content, args.vmhosts)
-        if len(vm_list) == 0:
-            logger.warning('Virtual Machine is not found')
-            sys.exit(1)
-
-        # Relocate(vMotion)のためのSpecデータ作成
-        relocate_spec = vim.VirtualMachineRelocateSpec()
-        if args.destination_esxi:
-            relocate_spec.host  = get.get_host_by_name(content, args.destination_esxi)
-            if relocate_spec.host is None:
-                logger.warning('ESXi host is not found')
-                sys.exit(1)
-
-        if args.destination_datastore:
-            relocate_spec.datastore = get.get_datastore_by_name(content, args.destination_datastore)
-            if relocate_spec.datastore is None:
-                logger.warning('Datastore is not found')
-                sys.exit(1)
-
-        if args.destination_pool:
-            relocate_spec.pool = get.get_pool(content, args.destination_pool)
-            if relocate_spec.pool is None:
-                logger.warning('Pool is not found')
-                sys.exit(1)
-
-        # 例) ['vim.Task:task-1137', 'vim.Task:task-1138', 'vim.Task:task-1139']
-        task_list = [vm.RelocateVM_Task(spec=relocate_spec, priority='defaultPriority') for vm in vm_list]
-
-        if len(task_list) == 0:
-            logger.error('Relocate task is not create')
-            sys.exit(2)
-
-        finish_tasks = {}
-        finish_tasks = wait_for_tasks(service_instance, task_list)
-
-        if len(finish_tasks) == 0:
-            logger.error('Finish task is not found')
-            sys.exit(2)
-
-        for key in finish_tasks.keys():
-            print_task(finish_tasks[key], args.timezone)
-            if finish_tasks[key].state == 'error':
-                exit_status = 2
-
-    except vmodl.MethodFault as ex:
-        logger.critical('Caught vmodl fault : ' + ex.msg)
-        import traceback
-        traceback.print_exc()
-        sys.exit(253)
-
-    except Exception as ex:
-        logger.critical('Caught exception : ' + str(ex))
-        import traceback
-        traceback.print_exc()
-        sys.exit(254)
-
-    sys.exit(exit_status)
+    sys.exit(fanout.run(args, run, logger))
 
 # Start program
 if __name__ == "__main__":